@@ -0,0 +1,52 @@
+"""Per-callback parsing cost: before and after decoding the body once.
+
+Usage: python benchmarks/bench_callback_parsing.py [-n NUMBER]
+"""
+import argparse
+import json
+import timeit
+
+from fixtures import CALLBACK
+from lina_community_version.core.messages import message_factory, \
+    NewMessage, MessageType
+from lina_community_version.core.serialization import DECODERS
+
+
+def before():
+    # middleware and VkCallback.post both decoded the body,
+    # message_factory rebuilt the field set for every message
+    data = json.loads(CALLBACK)
+    data = json.loads(CALLBACK)
+    if data.get('type') == MessageType.NewMessage.value:
+        field_names = set(NewMessage.__slots__)
+        NewMessage(**{k: v for k, v in data['object'].items()
+                      if k in field_names})
+
+
+def after(loads):
+    def parse():
+        data = loads(CALLBACK)
+        message_factory(data.get('type'), data.get('object', dict()))
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    cases = [('before (json x2)', before)]
+    cases += [('after (%s)' % name, after(loads))
+              for name, loads in DECODERS.items()]
+    baseline = None
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=args.number, repeat=5))
+        per_call = best / args.number * 1e6
+        if baseline is None:
+            baseline = per_call
+        print('%-20s %8.2f us/callback  x%.2f' % (
+            name, per_call, baseline / per_call))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Memory held by queued messages and cached member lists.
+
+The slotted models are compared with the dataclass layout they replaced.
+
+Usage: python benchmarks/bench_memory.py [-n NUMBER] [--members MEMBERS]
+"""
+import argparse
+import gc
+import json
+import tracemalloc
+from collections import deque
+from dataclasses import make_dataclass
+from typing import Any, Callable
+
+from fixtures import CALLBACK, GROUP_ID, profiles
+from lina_community_version.core.messages import NewMessage, message_factory
+from lina_community_version.core.profiles import UserProfile
+
+
+def members_response(members: int) -> bytes:
+    return json.dumps({'response': {
+        'count': members,
+        'items': [],
+        'profiles': profiles(members),
+    }}, ensure_ascii=False).encode()
+
+
+def legacy(cls) -> Any:
+    # the dataclass layout the models had before __slots__
+    return make_dataclass('Legacy' + cls.__name__, cls.__slots__)
+
+
+def retained(build: Callable[[], Any], number: int) -> float:
+    # bytes still allocated per item once the decoded bodies are gone
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    items = deque(build() for _ in range(number))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del items
+    return used / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    parser.add_argument('--members', type=int, default=30)
+    args = parser.parse_args()
+
+    legacy_message = legacy(NewMessage)
+    legacy_profile = legacy(UserProfile)
+    response = members_response(args.members)
+
+    def queued_message():
+        data = json.loads(CALLBACK)
+        return message_factory(data['type'], data['object'], GROUP_ID)
+
+    def queued_legacy_message():
+        data = json.loads(CALLBACK)
+        return legacy_message(**dict(data['object'],
+                                     ref=None, ref_source=None,
+                                     raw_text=None, reply_message=None,
+                                     action=None, payload=None,
+                                     group_id=GROUP_ID))
+
+    def member_list():
+        profiles = json.loads(response)['response']['profiles']
+        return [UserProfile.from_dict(data) for data in profiles]
+
+    def legacy_member_list():
+        profiles = json.loads(response)['response']['profiles']
+        return [legacy_profile(**dict(data, online_mobile=None,
+                                      online_app=None))
+                for data in profiles]
+
+    cases = [
+        ('queued message', args.number,
+         queued_legacy_message, queued_message),
+        ('member list (%s)' % args.members, args.number // args.members,
+         legacy_member_list, member_list),
+    ]
+    for name, number, before, after in cases:
+        old = retained(before, number)
+        new = retained(after, number)
+        print('%-20s %8.0f -> %8.0f bytes  x%.2f' % (name, old, new,
+                                                     old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""VK payloads shared by the benchmark scripts.
+
+The scripts are run as python benchmarks/<name>.py, which puts this
+directory on sys.path, so they import it as a top level module.
+"""
+import json
+from typing import Any, Dict, List
+
+GROUP_ID = 177216767
+
+MESSAGE: Dict[str, Any] = {
+    'date': 1550000000,
+    'from_id': 164555054,
+    'id': 0,
+    'out': 0,
+    'peer_id': 2000000001,
+    'text': '[club177216767|@Lina] 4Д6 kh3 +2',
+    'conversation_message_id': 4242,
+    'fwd_messages': [],
+    'important': False,
+    'random_id': 0,
+    'attachments': [],
+    'is_hidden': False,
+}
+
+
+def new_message(**fields: Any) -> Dict[str, Any]:
+    # message_new object, fields override the ones of MESSAGE
+    return dict(MESSAGE, **fields)
+
+
+def callback(message: Dict[str, Any] = MESSAGE,
+             group_id: int = GROUP_ID) -> Dict[str, Any]:
+    return {'type': 'message_new', 'group_id': group_id, 'object': message}
+
+
+CALLBACK = json.dumps(callback(), ensure_ascii=False).encode()
+
+
+def profiles(members: int) -> List[Dict[str, Any]]:
+    # profiles part of a messages.getConversationMembers response
+    return [dict(id=i,
+                 first_name='Пользователь%s' % i,
+                 last_name='Тестовый',
+                 is_closed=False,
+                 can_access_closed=True,
+                 sex=i % 3,
+                 screen_name='id%s' % i,
+                 photo_50='https://vk.com/images/camera_50.png',
+                 photo_100='https://vk.com/images/camera_100.png',
+                 online=i % 2,
+                 online_info=dict(visible=True))
+            for i in range(1, members + 1)]
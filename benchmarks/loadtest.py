@@ -0,0 +1,323 @@
+"""End-to-end load test: callbacks in, fake VK API out.
+
+Starts a local stand-in for api.vk.com, runs Lina against it in the
+same process and posts message_new callbacks at a fixed rate. With
+--ingestion longpoll the messages are served by the fake Long Poll
+server instead, latency is then the time until a_check returns them.
+
+Usage: python benchmarks/loadtest.py -c config.yml [--rate 200]
+       [--duration 10] [--api-latency 0.05] [--error-rate 0.01]
+       [--ingestion longpoll]
+"""
+import asyncio
+import json
+import time
+from collections import Counter
+from itertools import count
+from logging import WARNING
+from random import Random
+from typing import Any, Dict, List, Tuple
+
+from aiohttp import ClientSession, web
+
+from fixtures import callback, new_message, profiles
+from lina_community_version.lina.bot import Lina
+from lina_community_version.lina.handlers import LinaNewMessageHandler
+
+TEXTS = (
+    'лина ping',
+    'лина 2д20 +3',
+    'лина 4д6 kh3',
+    'лина 10d10 kl2 -1',
+    'лина монетка',
+    'лина инфа про нагрузочный тест',
+    'лина кто избран',
+    'лина кто виноват',
+    'лина рандом 1 100',
+    'лина чай или кофе',
+    'лина шар судьбы',
+    'просто сообщение без упоминания',
+    'обсуждаем вчерашнюю игру',
+)
+
+
+def parse_execute(code: str) -> List[Tuple[str, Dict[str, Any]]]:
+    # code looks like 'return [API.method({...}),API.method({...})];'
+    decoder = json.JSONDecoder()
+    calls = list()
+    pos = len('return [')
+    while code.startswith('API.', pos):
+        paren = code.index('(', pos)
+        params, end = decoder.raw_decode(code, paren + 1)
+        calls.append((code[pos + len('API.'):paren], params))
+        pos = end + len('),')
+    return calls
+
+
+class FakeVkApi:
+    def __init__(self,
+                 latency: float = 0.05,
+                 jitter: float = 0.5,
+                 error_rate: float = 0.0,
+                 error_code: int = 6,
+                 members: int = 20,
+                 seed: int = 0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.random = Random(seed)
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.requests = 0
+        self._ids = count(1)
+        # long poll events, ts is the index of the next one
+        self.events: List[Tuple[float, Dict[str, Any]]] = list()
+        self.delivered: List[float] = list()
+        self._new_events = asyncio.Event()
+        self.profiles = profiles(members)
+        self.app = web.Application()
+        self.app.router.add_route('*', '/method/{method}', self.handle)
+        self.app.router.add_get('/lp', self.check)
+        self.runner = web.AppRunner(self.app)
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%s/method/' % self.address
+
+    async def start(self, host: str, port: int):
+        self.address = (host, port)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def _failed(self, method: str) -> bool:
+        if method not in ('messages.send', 'messages.getConversationMembers'):
+            return False
+        if self.random.random() >= self.error_rate:
+            return False
+        self.errors[method] += 1
+        return True
+
+    def _error(self, method: str) -> Dict[str, Any]:
+        return dict(error_code=self.error_code,
+                    error_msg='injected error',
+                    method=method)
+
+    def _result(self, method: str) -> Any:
+        self.calls[method] += 1
+        if method == 'groups.getLongPollServer':
+            return dict(server='http://%s:%s/lp' % self.address,
+                        key='key',
+                        ts=str(len(self.events)))
+        if method == 'messages.getConversationMembers':
+            return dict(count=len(self.profiles),
+                        items=list(),
+                        profiles=self.profiles)
+        return next(self._ids)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        params: Dict[str, Any] = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        await asyncio.sleep(self.latency * (
+            1 + self.jitter * (2 * self.random.random() - 1)))
+        method = request.match_info['method']
+        if method != 'execute':
+            if self._failed(method):
+                return web.json_response(dict(error=self._error(method)))
+            return web.json_response(dict(response=self._result(method)))
+        results: List[Any] = list()
+        errors = list()
+        for name, _ in parse_execute(params['code']):
+            if self._failed(name):
+                results.append(False)
+                errors.append(self._error(name))
+            else:
+                results.append(self._result(name))
+        body: Dict[str, Any] = dict(response=results)
+        if errors:
+            body['execute_errors'] = errors
+        return web.json_response(body)
+
+    def push(self, event: Dict[str, Any]):
+        self.events.append((time.perf_counter(), event))
+        self._new_events.set()
+
+    async def check(self, request: web.Request) -> web.Response:
+        ts = int(request.query['ts'])
+        if ts >= len(self.events):
+            self._new_events.clear()
+            try:
+                await asyncio.wait_for(self._new_events.wait(),
+                                       float(request.query['wait']))
+            except asyncio.TimeoutError:
+                pass
+        events = self.events[ts:]
+        now = time.perf_counter()
+        self.delivered.extend(now - pushed for pushed, _ in events)
+        return web.json_response(dict(ts=str(ts + len(events)),
+                                      updates=[event for _, event in events]))
+
+
+class LoadGenerator:
+    def __init__(self,
+                 url: str,
+                 group_id: int,
+                 rate: float,
+                 duration: float,
+                 peers: int = 50,
+                 seed: int = 0) -> None:
+        self.url = url
+        self.group_id = group_id
+        self.rate = rate
+        self.duration = duration
+        self.peers = peers
+        self.random = Random(seed)
+        self.latencies: List[float] = list()
+        self.statuses: Counter = Counter()
+        self._cmids = count(1)
+
+    def callback(self) -> bytes:
+        return json.dumps(self.event(), ensure_ascii=False).encode()
+
+    def event(self) -> Dict[str, Any]:
+        return callback(new_message(
+            date=int(time.time()),
+            from_id=self.random.randint(1, 100000),
+            peer_id=2000000000 + self.random.randint(1, self.peers),
+            text=self.random.choice(TEXTS),
+            conversation_message_id=next(self._cmids)), self.group_id)
+
+    async def _post(self, session: ClientSession):
+        body = self.callback()
+        started = time.perf_counter()
+        try:
+            async with session.post(self.url, data=body) as response:
+                await response.read()
+                self.statuses[response.status] += 1
+        except Exception as e:
+            self.statuses[type(e).__name__] += 1
+            return
+        self.latencies.append(time.perf_counter() - started)
+
+    async def run(self) -> float:
+        # open loop: requests leave on schedule even if answers are late
+        total = int(self.rate * self.duration)
+        tasks = list()
+        async with ClientSession() as session:
+            started = time.perf_counter()
+            for i in range(total):
+                delay = started + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(
+                    self._post(session)))
+            await asyncio.gather(*tasks)
+            return time.perf_counter() - started
+
+
+class LongPollLoadGenerator(LoadGenerator):
+    def __init__(self, fake_api: FakeVkApi, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fake_api = fake_api
+        # the fake api records delivery times as a_check returns events
+        self.latencies = fake_api.delivered
+
+    async def _post(self, session: ClientSession):
+        self.fake_api.push(self.event())
+        self.statuses['queued'] += 1
+
+
+class LoadTestLina(Lina):
+    def add_args(self, parser):
+        super().add_args(parser)
+        parser.add_argument('--rate', type=float, default=200,
+                            help='callbacks per second')
+        parser.add_argument('--duration', type=float, default=10,
+                            help='seconds of load')
+        parser.add_argument('--peers', type=int, default=50)
+        parser.add_argument('--api-port', type=int, default=13667)
+        parser.add_argument('--api-latency', type=float, default=0.05)
+        parser.add_argument('--api-jitter', type=float, default=0.5)
+        parser.add_argument('--error-rate', type=float, default=0.0)
+        parser.add_argument('--error-code', type=int, default=6)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--ingestion', default='callback',
+                            choices=('callback', 'longpoll'))
+
+    def read_config(self, path: str):
+        cfg = super().read_config(path)
+        # every group talks to the fake api, the first one gets the load
+        cfg['api_url'] = 'http://%s:%s/method/' % (self.args.host,
+                                                   self.args.api_port)
+        for group in cfg.get('groups') or list():
+            group.pop('api_url', None)
+            group['ingestion'] = 'callback'
+        cfg['ingestion'] = self.args.ingestion
+        if cfg.get('groups'):
+            cfg['groups'][0]['ingestion'] = self.args.ingestion
+        return cfg
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def report(generator: LoadGenerator, fake_api: FakeVkApi, elapsed: float):
+    latencies = generator.latencies
+    sent = sum(generator.statuses.values())
+    print('messages:    %s in %.2fs, %.1f/s (target %.1f/s)' % (
+        sent, elapsed, sent / elapsed, generator.rate))
+    print('statuses:    %s' % dict(generator.statuses))
+    print('latency:     p50 %.2fms  p99 %.2fms  max %.2fms' % (
+        percentile(latencies, 0.5) * 1e3,
+        percentile(latencies, 0.99) * 1e3,
+        max(latencies, default=float('nan')) * 1e3))
+    print('vk requests: %s' % fake_api.requests)
+    print('vk calls:    %s' % dict(fake_api.calls))
+    print('vk errors:   %s' % dict(fake_api.errors))
+
+
+async def main():
+    lina = LoadTestLina()
+    lina.logger.setLevel(WARNING)
+    args = lina.args
+    fake_api = FakeVkApi(latency=args.api_latency,
+                         jitter=args.api_jitter,
+                         error_rate=args.error_rate,
+                         error_code=args.error_code,
+                         seed=args.seed)
+    await fake_api.start(args.host, args.api_port)
+    lina.setup_handler_class(LinaNewMessageHandler)
+    await lina.start()
+    settings = dict(group_id=lina.default_group.group_id,
+                    rate=args.rate,
+                    duration=args.duration,
+                    peers=args.peers,
+                    seed=args.seed)
+    generator: LoadGenerator
+    if args.ingestion == 'longpoll':
+        generator = LongPollLoadGenerator(fake_api, '', **settings)
+    else:
+        while lina.server.server is None:
+            await asyncio.sleep(0.01)
+        generator = LoadGenerator(
+            'http://%s:%s/%s/%s/callback' % (args.host, args.port,
+                                             lina.cfg['env'],
+                                             lina.cfg['callback_code']),
+            **settings)
+    elapsed = await generator.run()
+    await lina.stop()  # waits for queued messages and pending sends
+    await fake_api.stop()
+    report(generator, fake_api, elapsed)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,185 @@
+"""Microbenchmarks for the hot message path.
+
+Results are written as JSON so two commits can be compared:
+
+    python benchmarks/microbench.py -o before.json
+    python benchmarks/microbench.py -o after.json --compare before.json
+"""
+import argparse
+import json
+import platform
+import re
+import subprocess
+import sys
+import time
+import timeit
+from logging import getLogger
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Tuple
+
+from fixtures import GROUP_ID, MESSAGE
+from lina_community_version.core.dispatcher import TriggerDispatcher
+from lina_community_version.core.groups import Group
+from lina_community_version.core.messages import message_factory, NewMessage
+from lina_community_version.core.rng import create_random
+from lina_community_version.lina.dice import DiceParser, compile_dice, \
+    parse_dice
+from lina_community_version.lina.handlers import LinaNewMessageHandler, \
+    RegexpDiceMessageHandler
+
+BOT_NAMES = ['лина', 'бот']
+
+TEXTS = {
+    'mention': '[club177216767|@lina] 4д6 kh3 +2',
+    'name': 'лина, кто избран сегодня',
+    'miss': 'обычное сообщение в беседе, где бота никто не зовет',
+}
+
+DICE_TEXTS = {
+    'simple': ' д20',
+    'modifier': ' 2д20 +3',
+    'keep': ' 4д6 kh3 +2',
+    'long': ' бросаю 10d10 kl2 -1 на инициативу, как договаривались',
+    'terms': ' (2d6 + 1d4!) x2 + 3 kh',
+}
+
+POOL_SIZES = (10, 1000, 100000)
+
+Case = Tuple[str, Callable[[], Any]]
+
+
+def service() -> SimpleNamespace:
+    # handlers only need configuration, random source and loggers here
+    return SimpleNamespace(cfg=dict(request_timeout=5),
+                           random=create_random(seed=0),
+                           logger=getLogger('microbench'),
+                           message_logger=getLogger('microbench.messages'))
+
+
+def message_cases() -> List[Case]:
+    return [
+        ('message_factory',
+         lambda: message_factory('message_new', MESSAGE, GROUP_ID)),
+        ('NewMessage.__init__',
+         lambda: NewMessage(**MESSAGE)),
+    ]
+
+
+def mention_cases() -> List[Case]:
+    regexp_mention = re.compile(Group._regexp_template % (
+        GROUP_ID, '|'.join(BOT_NAMES)))
+
+    def mention(text: str) -> Callable[[], Any]:
+        def run():
+            if regexp_mention.search(text):
+                regexp_mention.sub('', text, count=1)
+        return run
+
+    return [('regexp_mention[%s]' % name, mention(text))
+            for name, text in TEXTS.items()]
+
+
+def dice_cases() -> List[Case]:
+    handler = RegexpDiceMessageHandler(service())  # type: ignore
+    cases: List[Case] = list()
+    for name, text in DICE_TEXTS.items():
+        expression = parse_dice(text)
+        assert expression is not None
+        cases.append(('dice.compile[%s]' % name,
+                      (lambda text: lambda: compile_dice.__wrapped__(
+                          DiceParser.expression_tokens(text)))(text)))
+        cases.append(('dice.parse_cached[%s]' % name,
+                      (lambda text: lambda: parse_dice(text))(text)))
+        cases.append(('dice.roll[%s]' % name,
+                      (lambda expression: lambda: expression.roll(
+                          handler.roller))(expression)))
+    for size in POOL_SIZES:
+        pool = handler.roller.roll(20, size)
+        cases.append(('dice.get_khl[%s]' % size,
+                      (lambda pool: lambda: handler.get_khl(
+                          pool, 'h', len(pool) // 2))(pool)))
+        cases.append(('dice.pool_to_str[%s]' % size,
+                      (lambda pool: lambda: handler.pool_to_str(pool))(pool)))
+    return cases
+
+
+def trigger_cases() -> List[Case]:
+    bot = service()
+    handlers = [handler(bot) for handler in  # type: ignore
+                LinaNewMessageHandler.__subclasses__()]
+    dispatcher = TriggerDispatcher(handlers)
+    return [('triggers.match[%s]' % name,
+             (lambda text: lambda: dispatcher.match(text))(text))
+            for name, text in TEXTS.items()]
+
+
+def all_cases() -> List[Case]:
+    return message_cases() + mention_cases() + dice_cases() + trigger_cases()
+
+
+def measure(func: Callable[[], Any],
+            repeat: int,
+            min_time: float) -> Dict[str, Any]:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return dict(number=number,
+                repeat=repeat,
+                best_ns=min(timings) * 1e9,
+                mean_ns=sum(timings) / len(timings) * 1e9)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='write results to this file')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks containing this string')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds per repeat')
+    args = parser.parse_args()
+
+    baseline: Dict[str, Any] = dict()
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)['benchmarks']
+
+    results: Dict[str, Any] = dict()
+    for name, func in all_cases():
+        if args.filter not in name:
+            continue
+        results[name] = result = measure(func, args.repeat, args.min_time)
+        line = '%-32s %12.1f ns' % (name, result['best_ns'])
+        if name in baseline:
+            line += '  x%.2f' % (baseline[name]['best_ns'] /
+                                 result['best_ns'])
+        print(line, file=sys.stderr)
+
+    report = dict(
+        meta=dict(revision=git_revision(),
+                  python=platform.python_version(),
+                  implementation=platform.python_implementation(),
+                  machine=platform.machine(),
+                  timestamp=int(time.time())),
+        benchmarks=results)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Replay recorded callbacks through Lina with VK API calls stubbed.
+
+Captures are written by the 'record' option of the server. Rotated
+files can be passed oldest first: capture.jsonl.2 capture.jsonl.1 ...
+
+Usage: python benchmarks/replay.py -c config.yml capture.jsonl
+       [--speed 1 | --speed 10 | --speed 0] [--profile out.prof]
+       [--tracemalloc 20]
+"""
+import asyncio
+import cProfile
+import pstats
+import time
+import tracemalloc
+from collections import Counter
+from itertools import count
+from logging import getLevelName
+from typing import Any, Dict, List, Optional
+
+from fixtures import profiles
+from lina_community_version.core.messages import message_factory
+from lina_community_version.core.recording import read_records
+from lina_community_version.core.vkapi import Priority
+from lina_community_version.lina.bot import Lina
+from lina_community_version.lina.handlers import LinaNewMessageHandler
+
+
+class StubScheduler:
+    # stands in for SendScheduler, nothing leaves the process
+    def __init__(self, members: int = 20) -> None:
+        self.calls: Counter = Counter()
+        self._ids = count(1)
+        self.profiles = profiles(members)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def submit(self,
+                     method: str,
+                     params: Dict[str, Any],
+                     peer_id: Optional[int] = None,
+                     priority: Priority = Priority.REPLY) -> Dict[str, Any]:
+        self.calls[method] += 1
+        if method == 'messages.getConversationMembers':
+            return dict(response=dict(count=len(self.profiles),
+                                      items=list(),
+                                      profiles=self.profiles))
+        return dict(response=next(self._ids))
+
+
+class ReplayLina(Lina):
+    def add_args(self, parser):
+        super().add_args(parser)
+        parser.add_argument('captures', nargs='+')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='1 is original speed, 0 is no pauses')
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--profile', help='write cProfile stats here')
+        parser.add_argument('--tracemalloc', type=int, default=0,
+                            help='show this many top allocation sites')
+        parser.add_argument('--log-level', default='WARNING')
+
+
+async def replay(lina: ReplayLina) -> Counter:
+    args = lina.args
+    statuses: Counter = Counter()
+    limit = asyncio.Semaphore(args.concurrency)
+    tasks: List[asyncio.Future] = list()
+
+    async def process(data: Dict[str, Any]):
+        try:
+            message = message_factory(data.get('type', ''),
+                                      data.get('object', dict()),
+                                      data.get('group_id'))
+            response = await lina.process_message(message)
+            statuses[response.status] += 1
+        except (TypeError, ValueError, KeyError):
+            statuses['invalid'] += 1  # bad body or unknown group
+        finally:
+            limit.release()
+
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    first_ts = None
+    for path in args.captures:
+        for ts, data in read_records(path, lina.cfg.get('json_decoder')):
+            if first_ts is None:
+                first_ts = ts
+            if args.speed > 0:
+                delay = started + (ts - first_ts) / args.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await limit.acquire()
+            tasks.append(asyncio.ensure_future(process(data)))
+    await asyncio.gather(*tasks)
+    return statuses
+
+
+async def main(lina: ReplayLina):
+    lina.logger.setLevel(getLevelName(lina.args.log_level))
+    for group in lina.groups.values():
+        group.api.scheduler = StubScheduler()  # type: ignore
+    lina.setup_handler_class(LinaNewMessageHandler)  # type: ignore
+    lina.init_handlers()
+    if lina.queue is not None:
+        await lina.queue.start()
+
+    profiler = cProfile.Profile() if lina.args.profile else None
+    if lina.args.tracemalloc:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    started = time.perf_counter()
+    statuses = await replay(lina)
+    if lina.queue is not None:
+        await lina.queue.stop()
+    elapsed = time.perf_counter() - started
+    if profiler is not None:
+        profiler.disable()
+
+    total = sum(statuses.values())
+    print('callbacks: %s in %.2fs, %.1f/s' % (
+        total, elapsed, total / elapsed))
+    print('statuses:  %s' % dict(statuses))
+    calls: Counter = Counter()
+    for group in lina.groups.values():
+        calls.update(group.api.scheduler.calls)  # type: ignore
+    print('vk calls:  %s' % dict(calls))
+    if profiler is not None:
+        profiler.dump_stats(lina.args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if lina.args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for stat in snapshot.statistics('lineno')[:lina.args.tracemalloc]:
+            print(stat)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(ReplayLina()))
@@ -0,0 +1,32 @@
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+class DedupCache:
+    # Keys live in a fixed ring, the oldest one is forgotten on overflow
+    def __init__(self, size: int = 10000, ttl: float = 60) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._ring: List[Optional[Tuple[Hashable, float]]] = [None] * size
+        self._seen: Dict[Hashable, float] = dict()
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def check(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        seen_at = self._seen.get(key)
+        if seen_at is not None and now - seen_at < self.ttl:
+            return True
+        old = self._ring[self._position]
+        if old is not None and self._seen.get(old[0]) == old[1]:
+            del self._seen[old[0]]
+        self._ring[self._position] = (key, now)
+        self._seen[key] = now
+        self._position = (self._position + 1) % self.size
+        return False
+
+    def forget(self, key: Hashable):
+        # the ring slot is left as is, it no longer matches on overflow
+        self._seen.pop(key, None)
@@ -0,0 +1,47 @@
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Pattern, Set
+
+from .handlers import BaseMessageHandler
+from .messages import NewMessage
+
+
+class TriggerDispatcher:
+    def __init__(self, handlers: Iterable[BaseMessageHandler]) -> None:
+        self.handlers: List[BaseMessageHandler] = list(handlers)
+        self._fallback: List[BaseMessageHandler] = list()
+        owners: Dict[str, Set[BaseMessageHandler]] = defaultdict(set)
+        for handler in self.handlers:
+            triggers = handler.get_triggers()
+            if not triggers:
+                self._fallback.append(handler)
+            for trigger in triggers:
+                owners[trigger].add(handler)
+
+        # The scan reports only the longest trigger starting at each position,
+        # so every trigger also fires the handlers of its own substrings
+        self._implied: Dict[str, Set[BaseMessageHandler]] = {
+            trigger: set().union(*(owners[other] for other in owners
+                                   if other in trigger))
+            for trigger in owners}
+
+        self.pattern: Optional[Pattern[str]] = None
+        if owners:
+            alternatives = sorted(owners, key=len, reverse=True)
+            self.pattern = re.compile(
+                '(?=(%s))' % '|'.join(map(re.escape, alternatives)))
+
+    def match(self, text: str) -> Set[BaseMessageHandler]:
+        if self.pattern is None:
+            return set()
+        found = {m.group(1) for m in self.pattern.finditer(text)}
+        return set().union(*(self._implied[trigger] for trigger in found))
+
+    async def dispatch(self, message: NewMessage) -> List[BaseMessageHandler]:
+        if message.raw_text is None:
+            return []
+        matched = self.match(message.raw_text)
+        for handler in self._fallback:
+            if await handler.is_triggered(message):
+                matched.add(handler)
+        return [handler for handler in self.handlers if handler in matched]
@@ -2,6 +2,8 @@ from enum import Enum
 
 
 class ErrorCodes(Enum):
+    TOO_MANY_REQUESTS = 6
+    FLOOD_CONTROL = 9
     ADMIN_PERMISSION_REQUIRED = 917
     URI_TOO_LONG = 414
 
@@ -20,3 +22,7 @@ class VKException(Exception):
 
 class VkSendErrorException(Exception):
     pass
+
+
+class QueueOverflowException(Exception):
+    pass
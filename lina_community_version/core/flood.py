@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Dict, Hashable, List, Optional
+
+from .ratelimit import TokenBucket
+
+
+class Verdict(Enum):
+    ALLOW = 'allow'
+    DROP = 'drop'
+    NOTICE = 'notice'
+
+
+class BucketMap:
+    # Buckets refill lazily when they are touched, the least recently
+    # used ones are forgotten once there are more than 'size' of them.
+    def __init__(self, rate: float, burst: float, size: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        # key -> [bucket, notice already sent]
+        self._entries: 'OrderedDict[Hashable, List[Any]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _entry(self, key: Hashable) -> List[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [TokenBucket(self.rate, self.burst),
+                                          False]
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    def check(self, key: Hashable, now: float) -> Verdict:
+        entry = self._entry(key)
+        if entry[0].try_acquire(now=now):
+            entry[1] = False
+            return Verdict.ALLOW
+        if entry[1]:
+            return Verdict.DROP
+        entry[1] = True  # one notice per burst of throttled messages
+        return Verdict.NOTICE
+
+
+class FloodControl:
+    def __init__(self,
+                 user: Optional[Dict[str, float]] = None,
+                 chat: Optional[Dict[str, float]] = None,
+                 size: int = 10000,
+                 notice: bool = False) -> None:
+        self.notice = notice
+        self.users = self._buckets(user, size)
+        self.chats = self._buckets(chat, size)
+
+    @staticmethod
+    def _buckets(cfg: Optional[Dict[str, float]],
+                 size: int) -> Optional[BucketMap]:
+        if cfg is None:
+            return None
+        return BucketMap(cfg['rate'], cfg.get('burst', max(cfg['rate'], 1)),
+                         size)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> 'FloodControl':
+        return cls(user=cfg.get('user'),
+                   chat=cfg.get('chat'),
+                   size=cfg.get('size', 10000),
+                   notice=cfg.get('notice', False))
+
+    def check(self, user: Hashable, chat: Hashable) -> Verdict:
+        now = time.monotonic()
+        for buckets, key in ((self.users, user), (self.chats, chat)):
+            if buckets is None:
+                continue
+            verdict = buckets.check(key, now)
+            if verdict is not Verdict.ALLOW:
+                if verdict is Verdict.NOTICE and not self.notice:
+                    return Verdict.DROP
+                return verdict
+        return Verdict.ALLOW
@@ -0,0 +1,44 @@
+import re
+from typing import Any, Dict, Optional
+
+from .longpoll import LongPoll
+from .vkapi import VkApi
+
+
+class Group:
+    _regexp_template = r'(^|\s)(\[club%s\|.+\]|%s)(,|\s|$)'
+
+    def __init__(self, owner, cfg: Dict[str, Any]) -> None:
+        self.owner = owner
+        self.cfg = cfg
+        self.group_id: int = cfg['group_id']
+        self.confirmation_code: str = cfg['confirmation_code']
+        self.regexp_mention = re.compile(
+            self._regexp_template %
+            (self.group_id, '|'.join(cfg['bot_names'])))
+        self.api = VkApi(owner, cfg)
+        self.longpoll: Optional[LongPoll] = None
+        if cfg.get('ingestion', 'callback') == 'longpoll':
+            longpoll_cfg = cfg.get('longpoll', dict())
+            self.longpoll = LongPoll(
+                self,
+                wait=longpoll_cfg.get('wait', 25),
+                retry_delay=longpoll_cfg.get('retry_delay', 3))
+
+    async def start(self):
+        await self.api.start()
+        if self.longpoll is not None:
+            await self.longpoll.start()
+
+    async def stop(self):
+        if self.longpoll is not None:
+            await self.longpoll.stop()
+        await self.api.close()
+
+
+def create_groups(owner, cfg: Dict[str, Any]) -> Dict[int, Group]:
+    # every entry of 'groups' overrides the top level settings
+    common = {key: value for key, value in cfg.items() if key != 'groups'}
+    groups = [Group(owner, dict(common, **entry))
+              for entry in cfg.get('groups') or [dict()]]
+    return {group.group_id: group for group in groups}
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from aiohttp import web
 from logging import Logger
+from typing import Any, Tuple
 
 from .messages import message_factory, NewMessage
 
@@ -15,26 +16,35 @@ class VkCallback(web.View):
         return self.owner.logger
 
     async def post(self) -> web.Response:
-        data = await self.request.json()
+        data = self.request['data']
         try:
             message = message_factory(data.get('type'),
-                                      data.get('object', dict()))
+                                      data.get('object', dict()),
+                                      data.get('group_id'))
             return await self.owner.process_message(message)
         except (TypeError, ValueError):
             self.logger.exception('Error with data: %s', data)
             return web.Response(status=504)
 
 
+class MetricsView(web.View):
+    async def get(self) -> web.Response:
+        return web.Response(
+            text=self.request.config_dict['owner'].metrics.render())
+
+
 class BaseMessageHandler(ABC):
     @abstractmethod
     async def is_triggered(self, message: NewMessage) -> bool:
         ...
 
     @abstractmethod
-    async def _handler(self, message: NewMessage):
+    async def get_content(self, message: NewMessage) -> Any:
+        ...
+
+    @abstractmethod
+    async def send_content(self, message: NewMessage, content: Any):
         ...
 
-    async def handler(self, message: NewMessage):
-        if not await self.is_triggered(message):
-            return
-        await self._handler(message)
+    def get_triggers(self) -> Tuple[str, ...]:
+        return tuple()
@@ -0,0 +1,84 @@
+import os
+import random
+from logging import Filter, Handler, INFO, Logger, LogRecord
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import List, Optional
+from weakref import WeakSet
+
+_queue_handlers: 'WeakSet[ListenerQueueHandler]' = WeakSet()
+
+
+class ListenerQueueHandler(QueueHandler):
+    # Records are put on a queue by the event loop thread and written by
+    # the listener thread. logging.shutdown closes the handler at exit,
+    # which writes out whatever is still queued.
+    def __init__(self, handlers: List[Handler]) -> None:
+        super().__init__(SimpleQueue())  # type: ignore
+        self.listener = QueueListener(self.queue, *handlers,
+                                      respect_handler_level=True)
+        self._running = False
+        _queue_handlers.add(self)
+
+    def start(self):
+        if not self._running:
+            self.listener.start()
+            self._running = True
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+def _restart_after_fork():
+    # The listener thread is not copied into forked workers and the queue
+    # may be left locked by it, records queued before the fork are written
+    # by the parent.
+    for handler in list(_queue_handlers):
+        if handler._running:
+            handler.queue = handler.listener.queue = SimpleQueue()
+            handler._running = False
+            handler.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def enable_queue_logging(logger: Logger) -> List[ListenerQueueHandler]:
+    # handlers of the logger and of the parents its records propagate to
+    # are moved behind a queue
+    queue_handlers: List[ListenerQueueHandler] = list()
+    current: Optional[Logger] = logger
+    while current is not None:
+        handlers = [handler for handler in current.handlers
+                    if not isinstance(handler, QueueHandler)]
+        if handlers:
+            for handler in handlers:
+                current.removeHandler(handler)
+            queue_handler = ListenerQueueHandler(handlers)
+            current.addHandler(queue_handler)
+            queue_handler.start()
+            queue_handlers.append(queue_handler)
+        current = current.parent if current.propagate else None
+    return queue_handlers
+
+
+class SampleFilter(Filter):
+    # Lets through a share of INFO and DEBUG records, warnings and errors
+    # always pass. Usable from log_config as
+    # {'()': 'lina_community_version.core.logs.SampleFilter', 'rate': 0.1}
+    def __init__(self, rate: float = 1.0) -> None:
+        super().__init__()
+        self.rate = rate
+        self._random = random.Random()
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno > INFO or self.rate >= 1:
+            return True
+        return self._random.random() < self.rate
@@ -0,0 +1,123 @@
+import asyncio
+from typing import Any, Dict, Optional, Set
+
+from aiohttp import ClientError, ClientTimeout
+
+from .exceptions import VKException
+from .messages import message_factory
+from .serialization import get_decoder
+
+
+class LongPoll:
+    def __init__(self,
+                 group,
+                 wait: int = 25,
+                 retry_delay: float = 3) -> None:
+        self.group = group
+        self.owner = group.owner
+        self.wait = wait
+        self.retry_delay = retry_delay
+        self.loads = get_decoder(self.owner.cfg.get('json_decoder'))
+        self.server: Optional[str] = None
+        self.key: Optional[str] = None
+        self.ts: Optional[str] = None
+        self._keep_ts = False
+        self._task: Optional[asyncio.Task] = None
+        self._updates: Set[asyncio.Future] = set()
+
+    @property
+    def logger(self):
+        return self.owner.logger
+
+    async def start(self):
+        self.logger.info('start long poll for group %s',
+                         self.group.group_id)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for update in self._updates:
+            update.cancel()
+        await asyncio.gather(*self._updates, return_exceptions=True)
+
+    async def update_server(self, update_ts: bool = True):
+        response = await self.group.api.get_long_poll_server(
+            self.group.group_id)
+        server = response['response']
+        self.server = server['server']
+        self.key = server['key']
+        if update_ts or self.ts is None:
+            self.ts = server['ts']
+
+    async def check(self) -> Dict[str, Any]:
+        session = self.group.api.session.driver.session
+        async with session.get(self.server,
+                               params={'act': 'a_check',
+                                       'key': self.key,
+                                       'ts': self.ts,
+                                       'wait': self.wait},
+                               timeout=ClientTimeout(
+                                   total=self.wait + 10)) as response:
+            return await response.json(loads=self.loads, content_type=None)
+
+    async def _run(self):
+        while True:
+            try:
+                if self.server is None:
+                    await self.update_server(update_ts=not self._keep_ts)
+                data = await self.check()
+                failed = data.get('failed')
+                if failed is None or failed == 1:
+                    # 1 - events were lost, continue from the new ts
+                    self.ts = data['ts']
+            except (ClientError, asyncio.TimeoutError, VKException) as e:
+                self.logger.error('Long poll error: %s', e)
+                await asyncio.sleep(self.retry_delay)
+                continue
+            except (ValueError, KeyError, AttributeError) as e:
+                # broken reply, get the server again but keep our ts
+                self.logger.error('Long poll bad response: %r', e)
+                self.server = None
+                self._keep_ts = True
+                await asyncio.sleep(self.retry_delay)
+                continue
+
+            if failed is None:
+                for update in data.get('updates', list()):
+                    if self.owner.queue is not None:
+                        # putting into the work queue is quick, and when
+                        # it blocks the poll should wait as well
+                        await self.handle_update(update)
+                    else:
+                        # handlers and sends must not hold up the next poll
+                        task = asyncio.ensure_future(
+                            self.handle_update(update))
+                        self._updates.add(task)
+                        task.add_done_callback(self._updates.discard)
+            elif failed != 1:
+                # 2 - key expired, 3 - key and ts expired
+                if failed not in (2, 3):
+                    self.logger.error('Long poll failed: %s', data)
+                self.server = None
+                self._keep_ts = failed == 2
+
+    async def handle_update(self, update: Dict[str, Any]):
+        try:
+            await self.process_update(update)
+        except Exception:
+            self.logger.exception('Error with update: %s', update)
+
+    async def process_update(self, update: Dict[str, Any]):
+        try:
+            message = message_factory(update.get('type', ''),
+                                      update.get('object', dict()),
+                                      self.group.group_id)
+        except ValueError:
+            return  # event type we do not handle
+        except TypeError:
+            self.logger.exception('Error with data: %s', update)
+            return
+        await self.owner.process_message(message)
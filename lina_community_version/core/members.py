@@ -0,0 +1,60 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from .profiles import UserProfile
+
+MEMBERSHIP_ACTIONS = frozenset(('chat_invite_user',
+                                'chat_invite_user_by_link',
+                                'chat_kick_user'))
+
+
+class MemberCache:
+    def __init__(self,
+                 loader: Callable[[int], Awaitable[List[UserProfile]]],
+                 ttl: float = 300,
+                 size: int = 1000) -> None:
+        self._loader = loader
+        self.ttl = ttl
+        self.size = size
+        self._entries: 'OrderedDict[int, Tuple[float, List[UserProfile]]]' = \
+            OrderedDict()
+        self._pending: Dict[int, asyncio.Future] = dict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, peer_id: int) -> List[UserProfile]:
+        entry = self._entries.get(peer_id)
+        if entry is not None:
+            expires, members = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(peer_id)
+                return members
+            del self._entries[peer_id]
+        pending = self._pending.get(peer_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(peer_id))
+            self._pending[peer_id] = pending
+        # a timed out caller must not cancel the load for the others
+        return await asyncio.shield(pending)
+
+    def invalidate(self, peer_id: int):
+        self._entries.pop(peer_id, None)
+        # a load started before the change must not be stored
+        self._pending.pop(peer_id, None)
+
+    async def _load(self, peer_id: int) -> List[UserProfile]:
+        task = asyncio.current_task()
+        try:
+            members = await self._loader(peer_id)
+        finally:
+            is_current = self._pending.get(peer_id) is task
+            if is_current:
+                del self._pending[peer_id]
+        if is_current:
+            self._entries[peer_id] = (time.monotonic() + self.ttl, members)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return members
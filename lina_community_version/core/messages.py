@@ -1,7 +1,6 @@
 import inspect
 
-from typing import Dict, Any, List, Union, Optional
-from dataclasses import dataclass, fields as df_fields
+from typing import Dict, Any, Sequence, Union, Optional
 from enum import Enum
 
 
@@ -10,39 +9,85 @@ class MessageType(Enum):
     Confirmation = 'confirmation'
 
 
-@dataclass()
+# Messages sit in queues and profiles in the member cache, so these are
+# plain classes with __slots__ instead of dataclasses with a __dict__,
+# and empty lists from the callback are replaced with a shared tuple.
 class BaseMessage:
-    pass
+    __slots__ = ()
 
 
-@dataclass()
 class Confirmation(BaseMessage):
-    pass
+    __slots__ = ('group_id',)
+
+    def __init__(self, group_id: Optional[int] = None) -> None:
+        self.group_id = group_id
+
+    def __repr__(self):
+        return 'Confirmation(group_id=%s)' % self.group_id
 
 
-@dataclass()
 class NewMessage(BaseMessage):
-    date: int
-    from_id: int
-    id: int
-    out: int
-    peer_id: int
-    text: str
-    conversation_message_id: int
-    fwd_messages: List[Any]
-    important: bool
-    random_id: int
-    attachments: List[Any]
-    is_hidden: bool
-    ref: Optional[str] = None
-    ref_source: Optional[str] = None
-    raw_text: Optional[str] = None
-    reply_message: Optional[Dict[str, Any]] = None
-    action: Optional[Dict[str, Any]] = None
-    payload: Optional[Any] = None
-
-    def __post_init__(self):
-        self.text = self.text.lower()
+    __slots__ = ('date', 'from_id', 'id', 'out', 'peer_id', 'text',
+                 'conversation_message_id', 'fwd_messages', 'important',
+                 'random_id', 'attachments', 'is_hidden', 'ref', 'ref_source',
+                 'raw_text', 'reply_message', 'action', 'payload', 'group_id')
+
+    def __init__(self,
+                 date: int,
+                 from_id: int,
+                 id: int,
+                 out: int,
+                 peer_id: int,
+                 text: str,
+                 conversation_message_id: int,
+                 fwd_messages: Sequence[Any],
+                 important: bool,
+                 random_id: int,
+                 attachments: Sequence[Any],
+                 is_hidden: bool,
+                 ref: Optional[str] = None,
+                 ref_source: Optional[str] = None,
+                 raw_text: Optional[str] = None,
+                 reply_message: Optional[Dict[str, Any]] = None,
+                 action: Optional[Dict[str, Any]] = None,
+                 payload: Optional[Any] = None,
+                 group_id: Optional[int] = None) -> None:
+        self.date = date
+        self.from_id = from_id
+        self.id = id
+        self.out = out
+        self.peer_id = peer_id
+        self.text = text.lower()
+        self.conversation_message_id = conversation_message_id
+        self.fwd_messages = fwd_messages or ()
+        self.important = important
+        self.random_id = random_id
+        self.attachments = attachments or ()
+        self.is_hidden = is_hidden
+        self.ref = ref
+        self.ref_source = ref_source
+        self.raw_text = raw_text
+        self.reply_message = reply_message
+        self.action = action
+        self.payload = payload
+        self.group_id = group_id
+
+    @classmethod
+    def from_dict(cls,
+                  data: Dict[str, Any],
+                  group_id: Optional[int] = None) -> 'NewMessage':
+        get = data.get
+        try:
+            return cls(data['date'], data['from_id'], data['id'], data['out'],
+                       data['peer_id'], data['text'],
+                       data['conversation_message_id'], data['fwd_messages'],
+                       data['important'], data['random_id'],
+                       data['attachments'], data['is_hidden'],
+                       get('ref'), get('ref_source'), get('raw_text'),
+                       get('reply_message'), get('action'), get('payload'),
+                       group_id)
+        except KeyError as e:
+            raise TypeError('message without field %s' % e) from None
 
     def get_text_or_attach(self) -> str:
         if self.text != '':
@@ -64,11 +109,12 @@ class NewMessage(BaseMessage):
 
 
 def message_factory(_type: str,
-                    data: Dict[str, Any]) -> Union[NewMessage, Confirmation]:
+                    data: Dict[str, Any],
+                    group_id: Optional[int] = None) -> Union[NewMessage,
+                                                             Confirmation]:
     if _type == MessageType.NewMessage.value:
-        field_names = set(f.name for f in df_fields(NewMessage))
-        return NewMessage(**{k:v for k,v in data.items() if k in field_names})
+        return NewMessage.from_dict(data, group_id)
     elif _type == MessageType.Confirmation.value:
-        return Confirmation()
+        return Confirmation(group_id=group_id)
     else:
         raise ValueError
@@ -0,0 +1,188 @@
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Metrics are only touched from the event loop thread, so plain dicts
+# and lists are enough and no locking is needed.
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+    def _labels(self, values: Labels) -> Dict[str, str]:
+        return dict(zip(self.labelnames, values))
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            if labels:
+                label_str = ','.join('%s="%s"' % (key, escape(str(label)))
+                                     for key, label in labels.items())
+                lines.append('%s{%s} %s' % (name, label_str,
+                                            format_value(value)))
+            else:
+                lines.append('%s %s' % (name, format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = dict()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, value in self._values.items():
+            yield self.name, self._labels(labels), value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self,
+                 *args,
+                 function: Optional[Callable[[], float]] = None,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.function = function
+        self._values: Dict[Labels, float] = dict()
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def samples(self) -> Iterator[Sample]:
+        if self.function is not None:
+            yield self.name, dict(), self.function()
+        for labels, value in self._values.items():
+            yield self.name, self._labels(labels), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self,
+                 *args,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # per label set: bucket counts followed by sum and count
+        self._values: Dict[Labels, List[float]] = dict()
+
+    def observe(self, value: float, *labels: str):
+        values = self._values.get(labels)
+        if values is None:
+            values = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, values in self._values.items():
+            label_dict = self._labels(labels)
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       dict(label_dict, le=format_value(bound)),
+                       cumulative)
+            yield self.name + '_sum', label_dict, values[-2]
+            yield self.name + '_count', label_dict, values[-1]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = list()
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = list()
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class LinaMetrics(MetricsRegistry):
+    def __init__(self) -> None:
+        super().__init__()
+        self.callbacks = Counter(
+            'lina_callbacks_received_total',
+            'Events received from VK', ('type',))
+        self.deduplicated = Counter(
+            'lina_callbacks_deduplicated_total',
+            'Redelivered events answered without processing')
+        self.queue_depth = Gauge(
+            'lina_queue_depth', 'Messages waiting in the work queue')
+        self.triggered = Counter(
+            'lina_handler_triggered_total',
+            'Messages that triggered a handler', ('handler',))
+        self.handler_duration = Histogram(
+            'lina_handler_duration_seconds',
+            'Time spent preparing a handler answer', ('handler',))
+        self.throttled = Counter(
+            'lina_messages_throttled_total',
+            'Messages dropped by flood control', ('verdict',))
+        self.handler_timeouts = Counter(
+            'lina_handler_timeouts_total',
+            'Handlers that did not answer in request_timeout', ('handler',))
+        self.api_duration = Histogram(
+            'lina_vk_api_request_duration_seconds',
+            'VK API request latency', ('method',))
+        self.api_errors = Counter(
+            'lina_vk_api_errors_total',
+            'VK API errors by method and error code', ('method', 'code'))
+        self.loop_lag = Histogram(
+            'lina_event_loop_lag_seconds',
+            'Delay of a scheduled wakeup of the event loop',
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        for metric in (self.callbacks, self.deduplicated, self.queue_depth,
+                       self.throttled, self.triggered,
+                       self.handler_duration,
+                       self.handler_timeouts, self.api_duration,
+                       self.api_errors, self.loop_lag):
+            self.register(metric)
+
+    async def monitor_loop_lag(self, interval: float = 1.0):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(loop.time() - started - interval, 0))
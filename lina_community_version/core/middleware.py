@@ -1,9 +1,19 @@
 from aiohttp.web import middleware, Response
 
 
+@middleware
+async def parse_json_middleware(request, handler):
+    # body is decoded once here and shared by the next handlers
+    if request.method == 'POST':
+        request['data'] = request.config_dict['json_loads'](
+            await request.read())
+    return await handler(request)
+
+
 @middleware
 async def check_group_middleware(request, handler):
-    data = await request.json()
-    if data['group_id'] != request.config_dict['owner'].cfg['group_id']:
+    data = request.get('data')  # only callbacks carry a body
+    if data is not None and \
+            data.get('group_id') not in request.config_dict['owner'].groups:
         return Response(status=400)  # Bad Request for invalid group id
     return await handler(request)
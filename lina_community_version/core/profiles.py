@@ -1,22 +1,52 @@
-from dataclasses import dataclass
-from typing import Optional, Dict
+from typing import Any, Optional, Dict
 
 
-@dataclass()
 class UserProfile:
-    id: int
-    first_name: str
-    last_name: str
-    is_closed: bool
-    can_access_closed: bool
-    sex: int
-    screen_name: str
-    photo_50: str
-    photo_100: str
-    online: int
-    online_info: Dict[str, bool]
-    online_mobile: Optional[int] = None
-    online_app: Optional[int] = None
+    __slots__ = ('id', 'first_name', 'last_name', 'is_closed',
+                 'can_access_closed', 'sex', 'screen_name', 'photo_50',
+                 'photo_100', 'online', 'online_info', 'online_mobile',
+                 'online_app')
+
+    def __init__(self,
+                 id: int,
+                 first_name: str,
+                 last_name: str,
+                 is_closed: bool,
+                 can_access_closed: bool,
+                 sex: int,
+                 screen_name: str,
+                 photo_50: str,
+                 photo_100: str,
+                 online: int,
+                 online_info: Dict[str, bool],
+                 online_mobile: Optional[int] = None,
+                 online_app: Optional[int] = None) -> None:
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.is_closed = is_closed
+        self.can_access_closed = can_access_closed
+        self.sex = sex
+        self.screen_name = screen_name
+        self.photo_50 = photo_50
+        self.photo_100 = photo_100
+        self.online = online
+        self.online_info = online_info
+        self.online_mobile = online_mobile
+        self.online_app = online_app
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'UserProfile':
+        # fields VK adds later are ignored instead of failing the lookup
+        get = data.get
+        try:
+            return cls(data['id'], data['first_name'], data['last_name'],
+                       data['is_closed'], data['can_access_closed'],
+                       data['sex'], data['screen_name'], data['photo_50'],
+                       data['photo_100'], data['online'], data['online_info'],
+                       get('online_mobile'), get('online_app'))
+        except KeyError as e:
+            raise TypeError('profile without field %s' % e) from None
 
     def __repr__(self):
         return '%s %s' % (self.first_name, self.last_name)
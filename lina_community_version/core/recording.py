@@ -0,0 +1,78 @@
+import os
+import time
+from typing import Any, BinaryIO, Iterator, Optional, Tuple
+
+from aiohttp.web import middleware
+
+from .serialization import get_decoder
+
+
+class CallbackRecorder:
+    # One JSON line per callback: {"ts":<unix time>,"data":<raw body>}.
+    # Files are rotated like logging.handlers.RotatingFileHandler does,
+    # path.1 is the newest finished file. '{pid}' in the path keeps
+    # worker processes from writing into the same file.
+    def __init__(self,
+                 path: str,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 backups: int = 5) -> None:
+        self.template = path
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._stream: Optional[BinaryIO] = None
+        self._size = 0
+
+    def open(self):
+        self.path = self.template.format(pid=os.getpid())
+        self._stream = open(self.path, 'ab')
+        self._size = self._stream.tell()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def record(self, body: bytes, ts: Optional[float] = None):
+        if self._stream is None:
+            return
+        # raw line breaks can only be whitespace in valid JSON
+        line = b'{"ts":%.6f,"data":%s}\n' % (
+            time.time() if ts is None else ts,
+            body.replace(b'\n', b' ').replace(b'\r', b' '))
+        if self._size and self._size + len(line) > self.max_bytes:
+            self._rotate()
+        self._stream.write(line)
+        self._size += len(line)
+
+    def _rotate(self):
+        self.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = '%s.%s' % (self.path, index)
+            if os.path.exists(source):
+                os.replace(source, '%s.%s' % (self.path, index + 1))
+        if self.backups:
+            os.replace(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+        self.open()
+
+
+@middleware
+async def record_middleware(request, handler):
+    if 'data' in request:
+        request.config_dict['recorder'].record(await request.read())
+    return await handler(request)
+
+
+def read_records(path: str,
+                 decoder: Optional[str] = None) -> Iterator[Tuple[float,
+                                                                  Any]]:
+    loads = get_decoder(decoder)
+    with open(path, 'rb') as stream:
+        for line in stream:
+            try:
+                record = loads(line)
+            except ValueError:
+                continue  # line cut short by a crash
+            yield record['ts'], record['data']
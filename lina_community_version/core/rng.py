@@ -0,0 +1,58 @@
+import os
+import random
+from typing import Optional, Union
+
+BPF = 53  # number of bits in a float
+RECIP_BPF = 2 ** -BPF
+
+
+class BufferedSystemRandom(random.Random):
+    # Same source as random.SystemRandom, but os.urandom is called for
+    # a whole block at once. Not meant to be shared between threads.
+    def __init__(self, block_size: int = 4096) -> None:
+        self.block_size = block_size
+        self._buffer = b''
+        self._position = 0
+        super().__init__()
+
+    def randbytes(self, n: int) -> bytes:
+        if n > self.block_size:
+            return os.urandom(n)
+        if len(self._buffer) - self._position < n:
+            self._buffer = os.urandom(self.block_size)
+            self._position = 0
+        result = self._buffer[self._position:self._position + n]
+        self._position += n
+        return result
+
+    def random(self) -> float:
+        return (int.from_bytes(self.randbytes(7), 'big') >> 3) * RECIP_BPF
+
+    def getrandbits(self, k: int) -> int:
+        if k < 0:
+            raise ValueError('number of bits must be non-negative')
+        numbytes = (k + 7) // 8
+        x = int.from_bytes(self.randbytes(numbytes), 'big')
+        return x >> (numbytes * 8 - k)
+
+    def seed(self, *args, **kwds) -> None:
+        return None
+
+    def _notimplemented(self, *args, **kwds):
+        raise NotImplementedError('System entropy source does not have state.')
+
+    getstate = setstate = _notimplemented  # type: ignore
+
+
+class SeededRandom(random.Random):
+    # Deterministic generator for tests and benchmarks
+    def randbytes(self, n: int) -> bytes:
+        return self.getrandbits(n * 8).to_bytes(n, 'little') if n else b''
+
+
+def create_random(seed: Optional[int] = None,
+                  block_size: int = 4096) -> Union[BufferedSystemRandom,
+                                                   SeededRandom]:
+    if seed is not None:
+        return SeededRandom(seed)
+    return BufferedSystemRandom(block_size)
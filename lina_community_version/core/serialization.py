@@ -0,0 +1,24 @@
+import json
+from typing import Any, Callable, Dict, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+JsonLoads = Callable[[Union[str, bytes]], Any]
+
+DECODERS: Dict[str, JsonLoads] = {'json': json.loads}
+if orjson is not None:
+    DECODERS['orjson'] = orjson.loads
+
+DEFAULT_DECODER = 'orjson' if 'orjson' in DECODERS else 'json'
+
+
+def get_decoder(name: Optional[str] = None) -> JsonLoads:
+    if name is None:
+        name = DEFAULT_DECODER
+    try:
+        return DECODERS[name]
+    except KeyError:
+        raise ValueError('Unknown json decoder: %s' % name)
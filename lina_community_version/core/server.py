@@ -1,30 +1,91 @@
 import asyncio
 from aiohttp.web import Application, AppRunner, view
-from lina_community_version.core.handlers import VkCallback
-from .middleware import check_group_middleware
+from lina_community_version.core.handlers import VkCallback, MetricsView
+from .middleware import check_group_middleware, parse_json_middleware
+from .recording import CallbackRecorder, record_middleware
+from .serialization import get_decoder
 
 
 class Server:
-    def __init__(self, owner):
+    def __init__(self, owner, callback: bool = True):
         self.owner = owner
-        self.app = Application(middlewares=[check_group_middleware])
+        self.callback = callback
+        middlewares = [parse_json_middleware]
+        self.recorder = None
+        record_cfg = owner.cfg.get('record')
+        if record_cfg is not None:
+            self.recorder = CallbackRecorder(
+                record_cfg['path'],
+                max_bytes=record_cfg.get('max_bytes', 64 * 1024 * 1024),
+                backups=record_cfg.get('backups', 5))
+            middlewares.append(record_middleware)
+        middlewares.append(check_group_middleware)
+        self.app = Application(middlewares=middlewares)
         self.app['owner'] = self.owner
-        self.app.add_routes(
-            (view('/%s/%s/callback' % (owner.cfg['env'],
-                                       owner.cfg['callback_code']),
-                  VkCallback),))  # type: ignore
+        self.app['recorder'] = self.recorder
+        self.app['json_loads'] = get_decoder(owner.cfg.get('json_decoder'))
+        if callback:
+            self.app.add_routes(
+                (view('/%s/%s/callback' % (owner.cfg['env'],
+                                           owner.cfg['callback_code']),
+                      VkCallback),))  # type: ignore
+
+        # /metrics has no auth, with metrics.port it gets its own listener
+        # instead of sharing the public callback one
+        metrics_cfg = owner.cfg.get('metrics', dict())
+        metrics_route = view(metrics_cfg.get('path', '/metrics'), MetricsView)
+        self.metrics_address = None
+        self.metrics_runner = None
+        if 'port' in metrics_cfg:
+            self.metrics_address = (metrics_cfg.get('host', '127.0.0.1'),
+                                    metrics_cfg['port'])
+            metrics_app = Application()
+            metrics_app['owner'] = self.owner
+            metrics_app.add_routes((metrics_route,))  # type: ignore
+            self.metrics_runner = AppRunner(metrics_app)
+        else:
+            self.app.add_routes((metrics_route,))  # type: ignore
 
         self.runner = AppRunner(self.app)
-        self.loop = asyncio.get_event_loop()
 
         self.server = None
+        self.metrics_server = None
 
     async def start(self):
+        if self.metrics_runner is not None:
+            self.owner.logger.info('start metrics server on %s:%s',
+                                   *self.metrics_address)
+            self.metrics_server = await self._listen(
+                self.metrics_runner, *self.metrics_address)
+        if not self.callback and self.metrics_runner is not None:
+            return  # nothing left for the main listener to serve
         self.owner.logger.info('start server')
-        await self.runner.setup()
-        self.server = await self.loop.create_server(self.runner.server,
-                                                    self.owner.args.host,
-                                                    self.owner.args.port)
+        if self.recorder is not None:
+            self.recorder.open()
+        self.server = await self._listen(self.runner,
+                                         self.owner.args.host,
+                                         self.owner.args.port)
+
+    async def _listen(self, runner, host, port):
+        await runner.setup()
+        # several worker processes share one port through SO_REUSEPORT
+        loop = asyncio.get_event_loop()
+        return await loop.create_server(
+            runner.server,
+            host,
+            port,
+            reuse_port=self.owner.args.workers > 1)
 
     async def stop(self):
-        await self.runner.shutdown()
+        if self.metrics_server is not None:
+            await self._close(self.metrics_server, self.metrics_runner)
+        if self.server is not None:
+            await self._close(self.server, self.runner)
+        if self.recorder is not None:
+            self.recorder.close()
+
+    @staticmethod
+    async def _close(server, runner):
+        server.close()
+        await runner.shutdown()
+        await server.wait_closed()
@@ -0,0 +1,83 @@
+import logging
+import os
+import signal
+import time
+from logging import Logger
+from typing import Callable, Dict
+
+
+class Supervisor:
+    def __init__(self,
+                 target: Callable[[], None],
+                 workers: int,
+                 logger: Logger,
+                 restart_delay: float = 1.0,
+                 shutdown_timeout: int = 10) -> None:
+        self.target = target
+        self.workers = workers
+        self.logger = logger
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self._children: Dict[int, float] = dict()
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGALRM, self._on_timeout)
+        for _ in range(self.workers):
+            self._spawn()
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self._children.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            self.logger.warning('worker %s exited with status %s, restarting',
+                                pid, status)
+            if time.monotonic() - started < self.restart_delay:
+                time.sleep(self.restart_delay)  # do not spin on crash loop
+            if not self._stopping:
+                self._spawn()
+        signal.alarm(0)
+        self.logger.info('all workers stopped')
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGALRM):
+                signal.signal(signum, signal.SIG_DFL)
+            code = 0
+            try:
+                self.target()
+            except BaseException:
+                self.logger.exception('worker %s crashed', os.getpid())
+                code = 1
+            finally:
+                logging.shutdown()  # queued records are lost on _exit
+                os._exit(code)
+        self.logger.info('started worker %s', pid)
+        self._children[pid] = time.monotonic()
+
+    def _kill(self, signum: int):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_stop(self, signum, _frame):
+        if self._stopping:
+            self._kill(signal.SIGKILL)
+            return
+        self.logger.info('stopping %s workers', len(self._children))
+        self._stopping = True
+        self._kill(signal.SIGTERM)
+        signal.alarm(self.shutdown_timeout)
+
+    def _on_timeout(self, _signum, _frame):
+        self.logger.warning('workers did not stop in %ss, killing',
+                            self.shutdown_timeout)
+        self._kill(signal.SIGKILL)
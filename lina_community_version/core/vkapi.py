@@ -1,10 +1,27 @@
+import asyncio
+import heapq
+import json
+from collections import deque
+from enum import IntEnum
+from itertools import count
+from logging import Logger
 from random import randint
-from typing import List, Callable, Awaitable, Any, Dict
-from aiohttp import ClientSession, ContentTypeError
+from typing import List, Callable, Awaitable, Any, Dict, Optional, \
+    Deque, Hashable, Sequence, Set, Tuple, Union
+from aiohttp import ClientSession, ClientTimeout, ContentTypeError, \
+    TCPConnector
 from aiovk import API, TokenSession
+from aiovk.drivers import BaseDriver, HttpDriver
 
+from .members import MemberCache
 from .profiles import UserProfile
-from .exceptions import VKException
+from .ratelimit import TokenBucket
+from .exceptions import VKException, ErrorCodes
+
+EXECUTE_LIMIT = 25  # API calls allowed in one execute request
+MESSAGE_LIMIT = 4096  # characters in one message
+RATE_LIMIT_CODES = frozenset((ErrorCodes.TOO_MANY_REQUESTS.value,
+                              ErrorCodes.FLOOD_CONTROL.value))
 
 
 def vk_exception(func: Callable[..., Awaitable[Dict[str, Any]]]):
@@ -19,9 +36,61 @@ def vk_exception(func: Callable[..., Awaitable[Dict[str, Any]]]):
     return wrapped_func
 
 
+class PooledHttpDriver(HttpDriver):
+    def __init__(self,
+                 timeout: int = 10,
+                 connect_timeout: Optional[float] = None,
+                 limit: int = 100,
+                 limit_per_host: int = 0,
+                 dns_ttl: int = 300,
+                 keepalive_timeout: float = 30) -> None:
+        BaseDriver.__init__(self, timeout)
+        self.connect_timeout = connect_timeout
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session: Optional[ClientSession] = None
+
+    async def open(self):
+        # session must be created inside the running loop
+        if self.session is not None and not self.session.closed:
+            return
+        connector = TCPConnector(limit=self.limit,
+                                 limit_per_host=self.limit_per_host,
+                                 ttl_dns_cache=self.dns_ttl,
+                                 keepalive_timeout=self.keepalive_timeout)
+        self.session = ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=self.timeout,
+                                  connect=self.connect_timeout))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
 class LinaTokenSession(TokenSession):
     API_VERSION = '5.92'
 
+    def __init__(self,
+                 access_token: Optional[str] = None,
+                 timeout: int = 10,
+                 driver: Optional[PooledHttpDriver] = None,
+                 request_url: Optional[str] = None) -> None:
+        super().__init__(access_token=access_token,
+                         timeout=timeout,
+                         driver=driver or PooledHttpDriver(timeout))
+        if request_url is not None:
+            self.REQUEST_URL = request_url
+
+    async def open(self):
+        await self.driver.open()
+
+    async def close(self):
+        await self.driver.close()
+
     async def send_api_request(self,
                                method_name: str,
                                params: dict = None,
@@ -35,61 +104,371 @@ class LinaTokenSession(TokenSession):
             params['access_token'] = self.access_token
         params['v'] = self.API_VERSION
 
-        # Send request
-        async with ClientSession() as session:
-            response = None
+        # Send request, parameters go in the body so long messages fit
+        session = self.driver.session
+        if session is None:
+            raise RuntimeError('LinaTokenSession is not opened')
+        response = None
+        try:
+            async with session.post(
+                    self.REQUEST_URL + method_name,
+                    data=params,
+                    timeout=ClientTimeout(total=timeout)) as response:
+                return await response.json()
+        except ContentTypeError as e:
+            if response is not None:
+                if response.status != 200:
+                    raise VKException(error_code=response.status,
+                                      error_text='http error')
+            raise e
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    # cut at a line break or a space in the second half of the limit,
+    # a word longer than that is cut as is
+    parts: List[str] = list()
+    while len(text) > limit:
+        cut = text.rfind('\n', limit // 2, limit + 1)
+        if cut == -1:
+            cut = text.rfind(' ', limit // 2, limit + 1)
+        if cut == -1:
+            cut = limit
+        part = text[:cut].rstrip()
+        if part:
+            parts.append(part)
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+class Priority(IntEnum):
+    REPLY = 0
+    ERROR = 1
+
+
+class SendJob:
+    def __init__(self,
+                 method: str,
+                 params: Dict[str, Any],
+                 priority: Priority,
+                 seq: int) -> None:
+        self.method = method
+        self.params = params
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.future: asyncio.Future = \
+            asyncio.get_event_loop().create_future()
+
+
+ApiCall = Callable[[str, Dict[str, Any]], Awaitable[Dict[str, Any]]]
+ApiExecute = Callable[[List[Tuple[str, Dict[str, Any]]]],
+                      Awaitable[List[Union[Dict[str, Any], VKException]]]]
+
+
+class SendScheduler:
+    def __init__(self,
+                 logger: Logger,
+                 call: ApiCall,
+                 execute: Optional[ApiExecute] = None,
+                 rate: float = 20,
+                 burst: Optional[float] = None,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 batch_size: int = 25,
+                 batch_window: float = 0.02) -> None:
+        self.logger = logger
+        self.call = call
+        self.execute = execute
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = min(batch_size, EXECUTE_LIMIT) if execute else 1
+        self.batch_window = batch_window
+        # one FIFO lane per peer, only the head of a lane is ever ready
+        self._lanes: Dict[Hashable, Deque[SendJob]] = dict()
+        self._ready: List[Tuple[int, int, Hashable]] = list()
+        self._counter = count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return sum(map(len, self._lanes.values()))
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for lane in self._lanes.values():
+            for job in lane:
+                job.future.cancel()
+        self._lanes.clear()
+        self._ready.clear()
+
+    async def submit(self,
+                     method: str,
+                     params: Dict[str, Any],
+                     peer_id: Optional[int] = None,
+                     priority: Priority = Priority.REPLY) -> Dict[str, Any]:
+        if self._task is None:
+            return await self.call(method, params)
+        job = SendJob(method, params, priority, next(self._counter))
+        key: Hashable = peer_id if peer_id is not None else ('job', job.seq)
+        lane = self._lanes.get(key)
+        if lane is None:
+            self._lanes[key] = deque((job,))
+            self._push(key)
+        else:
+            lane.append(job)
+        return await job.future
+
+    def _push(self, key: Hashable):
+        lane = self._lanes.get(key)
+        if not lane:
+            return
+        head = lane[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, key))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        assert self._wakeup is not None
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            self._skip_abandoned()
+            if not self._ready:
+                continue
+            await self.bucket.acquire()
+            if len(self._ready) < self.batch_size:
+                # let more calls join the same execute request
+                await asyncio.sleep(self.batch_window)
+            keys = [heapq.heappop(self._ready)[2] for _ in
+                    range(min(self.batch_size, len(self._ready)))]
+            task = asyncio.create_task(self._send(keys))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _send(self, keys: List[Hashable]):
+        jobs = list()
+        for key in keys:
+            job = self._lanes[key][0]
+            if job.future.done():  # caller has given up waiting
+                self._advance(key)
+            else:
+                jobs.append((key, job))
+        if not jobs:
+            return
+        results: List[Union[Dict[str, Any], Exception]]
+        if len(jobs) == 1:
+            job = jobs[0][1]
+            try:
+                results = [await self.call(job.method, job.params)]
+            except Exception as e:
+                results = [e]
+        elif jobs:
+            assert self.execute is not None
             try:
-                async with session.get(
-                        self.REQUEST_URL + method_name,
-                        params=params or {},
-                        timeout=timeout or self.timeout) as response:
-                    return await response.json()
-            except ContentTypeError as e:
-                if response is not None:
-                    if response.status != 200:
-                        raise VKException(error_code=response.status,
-                                          error_text='http error')
-                raise e
+                results = list(await self.execute(
+                    [(job.method, job.params) for _, job in jobs]))
+            except Exception as e:
+                results = [e] * len(jobs)
+        for (key, job), result in zip(jobs, results):
+            self._complete(key, job, result)
+
+    def _complete(self,
+                  key: Hashable,
+                  job: SendJob,
+                  result: Union[Dict[str, Any], Exception]):
+        if isinstance(result, VKException) and \
+                result.code in RATE_LIMIT_CODES and \
+                job.attempts < self.retries:
+            job.attempts += 1
+            self.bucket.drain()
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            self.logger.warning('Rate limited (%s), retry in %ss',
+                                result, delay)
+            asyncio.get_event_loop().call_later(delay, self._push, key)
+            return
+        if not job.future.done():
+            if isinstance(result, Exception):
+                job.future.set_exception(result)
+            else:
+                job.future.set_result(result)
+        self._advance(key)
+
+    def _skip_abandoned(self):
+        # heads whose caller has given up should not cost a token
+        while self._ready:
+            key = self._ready[0][2]
+            if not self._lanes[key][0].future.done():
+                return
+            heapq.heappop(self._ready)
+            self._advance(key)
+
+    def _advance(self, key: Hashable):
+        lane = self._lanes[key]
+        lane.popleft()
+        if lane:
+            self._push(key)
+        else:
+            del self._lanes[key]
 
 
 class VkApi:
-    def __init__(self, owner) -> None:
+    def __init__(self, owner, cfg: Optional[Dict[str, Any]] = None) -> None:
         self.owner = owner
-        self.token = self.owner.cfg['token']
-        self.session = LinaTokenSession(access_token=self.token)
+        self.cfg = cfg if cfg is not None else owner.cfg
+        self.token = self.cfg['token']
+        http_cfg = self.cfg.get('http', dict())
+        self.session = LinaTokenSession(
+            access_token=self.token,
+            timeout=http_cfg.get('timeout', 10),
+            driver=PooledHttpDriver(
+                timeout=http_cfg.get('timeout', 10),
+                connect_timeout=http_cfg.get('connect_timeout'),
+                limit=http_cfg.get('limit', 100),
+                limit_per_host=http_cfg.get('limit_per_host', 0),
+                dns_ttl=http_cfg.get('dns_ttl', 300),
+                keepalive_timeout=http_cfg.get('keepalive_timeout', 30)),
+            request_url=self.cfg.get('api_url'))
         self.api: API = API(self.session)
+        members_cfg = self.cfg.get('members_cache', dict())
+        self.members = MemberCache(self._load_conversation_members,
+                                   ttl=members_cfg.get('ttl', 300),
+                                   size=members_cfg.get('size', 1000))
+        rate_cfg = self.cfg.get('rate_limit', dict())
+        execute_cfg = self.cfg.get('execute')
+        self.scheduler = SendScheduler(
+            self.owner.logger,
+            self._call,
+            self._execute if execute_cfg is not None else None,
+            rate=rate_cfg.get('rate', 20),
+            burst=rate_cfg.get('burst'),
+            retries=rate_cfg.get('retries', 3),
+            backoff=rate_cfg.get('backoff', 0.5),
+            batch_size=(execute_cfg or dict()).get('size', EXECUTE_LIMIT),
+            batch_window=(execute_cfg or dict()).get('window', 0.02))
+
+    async def start(self):
+        await self.session.open()
+        await self.scheduler.start()
+
+    async def close(self):
+        await self.scheduler.stop()
+        await self.session.close()
 
-    @vk_exception
     async def send_message(self,
                            peer_id: int,
                            message: str) -> Dict[str, Any]:
-        self.owner.logger.info(
-            '--> send message: peer_id %s, message %s' % (peer_id,
-                                                          message))
-        return await self.api.messages.send(peer_id=peer_id,
-                                            message=message,
-                                            random_id=randint(10000, 99999))
+        responses = await self.send_messages(peer_id, (message,))
+        return responses[-1]
 
-    @vk_exception
-    async def send_sticker(self, peer_id: int, sticker_id: int):
-        self.owner.logger.info(
-            '--> send sticker: peer_id %s, sticker_id %s' % (peer_id,
-                                                             sticker_id))
-        return await self.api.messages.send(peer_id=peer_id,
-                                            sticker_id=sticker_id,
-                                            random_id=randint(10000, 99999))
+    async def send_messages(self,
+                            peer_id: int,
+                            messages: Sequence[str]) -> List[Dict[str, Any]]:
+        # Parts are queued at once, the peer's lane in the scheduler keeps
+        # their order and the rate limit paces them.
+        parts = [part for message in messages
+                 for part in split_message(message)]
+        for part in parts:
+            self.owner.message_logger.info(
+                '--> send message: peer_id %s, message %s', peer_id, part)
+        return await asyncio.gather(*(
+            self.scheduler.submit('messages.send',
+                                  dict(peer_id=peer_id,
+                                       message=part,
+                                       random_id=randint(10000, 99999)),
+                                  peer_id=peer_id)
+            for part in parts))
+
+    async def send_sticker(self,
+                           peer_id: int,
+                           sticker_id: int,
+                           priority: Priority = Priority.REPLY):
+        self.owner.message_logger.info(
+            '--> send sticker: peer_id %s, sticker_id %s', peer_id,
+            sticker_id)
+        return await self.scheduler.submit(
+            'messages.send',
+            dict(peer_id=peer_id,
+                 sticker_id=sticker_id,
+                 random_id=randint(10000, 99999)),
+            peer_id=peer_id,
+            priority=priority)
 
     @vk_exception
-    async def _get_conversation_members(self, peer_id: int):
-        return await self.api.messages.getConversationMembers(peer_id=peer_id)
+    async def _request(self, method: str, params: Dict[str, Any]):
+        return await self.api(method, **params)
+
+    async def _measure(self, method: str, request: Awaitable[Any]):
+        metrics = self.owner.metrics
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            return await request
+        except Exception as e:
+            metrics.api_errors.inc(method, str(e.code) if isinstance(
+                e, VKException) else type(e).__name__)
+            raise
+        finally:
+            metrics.api_duration.observe(loop.time() - started, method)
+
+    async def _call(self, method: str, params: Dict[str, Any]):
+        return await self._measure(method, self._request(method, params))
+
+    async def _call_execute(self, code: str):
+        return await self._measure('execute',
+                                   self._request('execute', dict(code=code)))
+
+    async def _execute(self, calls: List[Tuple[str, Dict[str, Any]]]) \
+            -> List[Union[Dict[str, Any], VKException]]:
+        code = 'return [%s];' % ','.join(
+            'API.%s(%s)' % (method, json.dumps(params, ensure_ascii=False))
+            for method, params in calls)
+        response = await self._call_execute(code)
+        # failed calls return false, their errors are listed in order
+        errors = iter(response.get('execute_errors', list()))
+        results: List[Union[Dict[str, Any], VKException]] = list()
+        for (method, _), result in zip(calls, response['response']):
+            if result is False:
+                error: Dict[str, Any] = next(errors, dict())
+                self.owner.metrics.api_errors.inc(
+                    method, str(error.get('error_code', 0)))
+                results.append(VKException(error.get('error_msg', ''),
+                                           error.get('error_code', 0)))
+            else:
+                results.append({'response': result})
+        return results
+
+    async def get_long_poll_server(self, group_id: int) -> Dict[str, Any]:
+        return await self.scheduler.submit('groups.getLongPollServer',
+                                           dict(group_id=group_id))
 
     async def get_conversation_members(self,
                                        peer_id: int) -> List[UserProfile]:
-        response = await self._get_conversation_members(peer_id=peer_id)
-        return [UserProfile(**data) for data in
+        return await self.members.get(peer_id)
+
+    async def _load_conversation_members(self,
+                                         peer_id: int) -> List[UserProfile]:
+        response = await self.scheduler.submit(
+            'messages.getConversationMembers',
+            dict(peer_id=peer_id),
+            peer_id=peer_id)
+        return [UserProfile.from_dict(data) for data in
                 response['response']['profiles'] if not data.get('deactivated',
                                                              False)]
 
     async def send_error_sticker(self, peer_id: int):
         await self.send_sticker(peer_id=peer_id,
-                                sticker_id=8471)
+                                sticker_id=8471,
+                                priority=Priority.ERROR)
@@ -0,0 +1,189 @@
+import asyncio
+from collections import deque
+from enum import Enum
+from logging import Logger
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, \
+    Optional
+
+from .exceptions import QueueOverflowException
+
+
+class OverflowPolicy(Enum):
+    DROP = 'drop'
+    REJECT = 'reject'
+    BLOCK = 'block'
+
+
+class BaseWorkQueue:
+    default_workers = 4
+
+    def __init__(self,
+                 worker: Callable[[Any], Awaitable[None]],
+                 logger: Logger,
+                 size: int = 1000,
+                 workers: Optional[int] = None,
+                 overflow: str = OverflowPolicy.BLOCK.value) -> None:
+        self._worker = worker
+        self.logger = logger
+        self.size = size
+        self.workers = workers if workers is not None else \
+            self.default_workers
+        self.overflow = OverflowPolicy(overflow)
+
+    @classmethod
+    def from_config(cls,
+                    worker: Callable[[Any], Awaitable[None]],
+                    logger: Logger,
+                    cfg: dict) -> 'BaseWorkQueue':
+        return cls(worker,
+                   logger,
+                   size=cfg.get('size', 1000),
+                   workers=cfg.get('workers'),
+                   overflow=cfg.get('overflow', OverflowPolicy.BLOCK.value))
+
+    @property
+    def depth(self) -> int:
+        raise NotImplementedError
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    async def put(self, item: Any) -> bool:
+        raise NotImplementedError
+
+    def _overflow(self, item: Any) -> bool:
+        self.logger.warning('Work queue is full, %s: %s',
+                            self.overflow.value, item)
+        if self.overflow is OverflowPolicy.REJECT:
+            raise QueueOverflowException
+        return False
+
+    async def _process(self, item: Any):
+        try:
+            await self._worker(item)
+        except Exception:
+            self.logger.exception('Error processing %s', item)
+
+
+class WorkQueue(BaseWorkQueue):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        # queue is created here to bind it to the running loop
+        self._queue = asyncio.Queue(maxsize=self.size)
+        self._tasks = [asyncio.create_task(self._run())
+                       for _ in range(self.workers)]
+
+    async def stop(self):
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, item: Any) -> bool:
+        if self._queue is None:
+            raise RuntimeError('WorkQueue is not started')
+        if self.overflow is OverflowPolicy.BLOCK:
+            await self._queue.put(item)
+            return True
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return self._overflow(item)
+
+    async def _run(self):
+        assert self._queue is not None
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._process(item)
+            finally:
+                self._queue.task_done()
+
+
+def peer_key(message: Any) -> Hashable:
+    return message.group_id, message.peer_id
+
+
+class PeerWorkQueue(BaseWorkQueue):
+    # Items with the same key run one after another in their own lane,
+    # lanes run in parallel and disappear once they are empty.
+    # 'workers' limits how many lanes run at once, 0 means no limit.
+    default_workers = 0
+
+    def __init__(self,
+                 *args,
+                 key: Callable[[Any], Hashable] = peer_key,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.key = key
+        self._lanes: Dict[Hashable, Deque[Any]] = dict()
+        self._tasks: Dict[Hashable, asyncio.Task] = dict()
+        self._pending = 0
+        self._capacity: Optional[asyncio.Semaphore] = None
+        self._running: Optional[asyncio.Semaphore] = None
+
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    @property
+    def lanes(self) -> int:
+        return len(self._lanes)
+
+    async def start(self):
+        self._capacity = asyncio.Semaphore(self.size)
+        if self.workers:
+            self._running = asyncio.Semaphore(self.workers)
+
+    async def stop(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(),
+                                 return_exceptions=True)
+
+    async def put(self, item: Any) -> bool:
+        if self._capacity is None:
+            raise RuntimeError('PeerWorkQueue is not started')
+        if self.overflow is not OverflowPolicy.BLOCK and \
+                self._capacity.locked():
+            return self._overflow(item)
+        await self._capacity.acquire()
+        self._pending += 1
+        key = self.key(item)
+        lane = self._lanes.get(key)
+        if lane is None:
+            self._lanes[key] = deque((item,))
+            self._tasks[key] = asyncio.create_task(self._drain(key))
+        else:
+            lane.append(item)
+        return True
+
+    async def _drain(self, key: Hashable):
+        assert self._capacity is not None
+        lane = self._lanes[key]
+        try:
+            while lane:
+                if self._running is not None:
+                    async with self._running:
+                        await self._process(lane[0])
+                else:
+                    await self._process(lane[0])
+                lane.popleft()
+                self._pending -= 1
+                self._capacity.release()
+        finally:
+            del self._lanes[key]
+            del self._tasks[key]
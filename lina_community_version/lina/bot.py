@@ -3,24 +3,35 @@ import re
 import argparse
 import yaml
 
+from aiohttp import ClientError
 from aiohttp.web import Response
 from logging import config, getLogger, StreamHandler, INFO
-from typing import Union, Set, Optional
+from typing import Union, List, Optional, Dict, Tuple
 
 from lina_community_version.core.server import Server
+from lina_community_version.core.groups import Group, create_groups
 from lina_community_version.core.vkapi import VkApi
 from lina_community_version.core.exceptions import VKException, \
-    VkSendErrorException
+    VkSendErrorException, QueueOverflowException
 from lina_community_version.core.messages import Confirmation, NewMessage
 from lina_community_version.core.handlers import BaseMessageHandler
+from lina_community_version.core.dispatcher import TriggerDispatcher
+from lina_community_version.core.workers import BaseWorkQueue, WorkQueue, \
+    PeerWorkQueue
+from lina_community_version.core.rng import create_random
+from lina_community_version.core.members import MEMBERSHIP_ACTIONS
+from lina_community_version.core.dedup import DedupCache
+from lina_community_version.core.flood import FloodControl, Verdict
+from lina_community_version.core.metrics import LinaMetrics
+from lina_community_version.core.logs import enable_queue_logging, \
+    SampleFilter
 
 
 class Lina:
-    _regexp_template = r'(^|\s)(\[club%s\|.+\]|%s)(,|\s|$)'
-
     def __init__(self):
         self._handler_class: Optional[BaseMessageHandler] = None
-        self._handlers: Set[BaseMessageHandler] = set()
+        self._handlers: List[BaseMessageHandler] = list()
+        self.dispatcher = TriggerDispatcher(self._handlers)
         parser = argparse.ArgumentParser()
         self.add_args(parser)
         self.args = parser.parse_args()
@@ -31,14 +42,63 @@ class Lina:
             self.logger = getLogger(self.cfg['logger_name'])
         else:
             self.logger = self.create_logger()
+        logging_cfg = self.cfg.get('logging', dict())
+        if logging_cfg.get('queue', False):
+            enable_queue_logging(self.logger)
+        # lines written for every message, they can be sampled
+        self.message_logger = self.logger.getChild('messages')
+        if 'sample' in logging_cfg:
+            self.message_logger.addFilter(
+                SampleFilter(logging_cfg['sample']))
         self.logger.info(self.cfg)
 
-        self.regexp_mention = re.compile(
-            self._regexp_template %
-            (self.cfg['group_id'], '|'.join(self.cfg['bot_names'])))
+        random_cfg = self.cfg.get('random', dict())
+        self.random = create_random(seed=random_cfg.get('seed'),
+                                    block_size=random_cfg.get('block_size',
+                                                              4096))
+
+        self.metrics = LinaMetrics()
+        self.metrics.queue_depth.function = lambda: self.queue_depth
+        self._lag_monitor: Optional[asyncio.Task] = None
+        self.groups: Dict[int, Group] = create_groups(self, self.cfg)
+        # the server also serves /metrics, so it runs without callbacks too
+        self.server = Server(self, callback=not all(
+            group.longpoll is not None for group in self.groups.values()))
+        self.default_group = next(iter(self.groups.values()))
+        # api of the first group, handlers should use get_api(message)
+        self.api: VkApi = self.default_group.api
+        # each --workers process has its own cache, redeliveries are only
+        # caught when the kernel hands them to the same worker
+        dedup_cfg = self.cfg.get('dedup', dict())
+        self.dedup = DedupCache(size=dedup_cfg.get('size', 10000),
+                                ttl=dedup_cfg.get('ttl', 60))
+        self.flood: Optional[FloodControl] = None
+        if 'flood' in self.cfg:
+            self.flood = FloodControl.from_config(self.cfg['flood'])
+        self.queue: Optional[BaseWorkQueue] = None
+        if 'queue' in self.cfg:
+            queue_class = PeerWorkQueue \
+                if self.cfg['queue'].get('ordering') == 'peer' else WorkQueue
+            self.queue = queue_class.from_config(self._process_new_message,
+                                                 self.logger,
+                                                 self.cfg['queue'])
+
+    @property
+    def longpoll_enabled(self) -> bool:
+        return any(group.longpoll is not None
+                   for group in self.groups.values())
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.depth if self.queue is not None else 0
 
-        self.server = Server(self)
-        self.api = VkApi(self)
+    def get_group(self, message: Union[Confirmation, NewMessage]) -> Group:
+        if message.group_id is None:
+            return self.default_group
+        return self.groups[message.group_id]
+
+    def get_api(self, message: Union[Confirmation, NewMessage]) -> VkApi:
+        return self.get_group(message).api
 
     @staticmethod
     def create_logger():
@@ -51,26 +111,50 @@ class Lina:
         parser.add_argument('-c', '--cfg', default='config.yml')
         parser.add_argument('--host', default='127.0.0.1')
         parser.add_argument('--port', default=13666, type=int)
+        parser.add_argument('--workers', default=1, type=int)
 
     def setup_handler_class(self, handler_class: BaseMessageHandler):
         self._handler_class = handler_class
 
     def init_handlers(self):
-        self._handlers = {handler(self) for handler in
-                          self._handler_class.__subclasses__()}
+        self._handlers = [handler(self) for handler in
+                          self._handler_class.__subclasses__()]
+        self.dispatcher = TriggerDispatcher(self._handlers)
 
     def read_config(self, path: str):
         with open(path) as stream:
             return yaml.load(stream)
 
     async def start(self):
-        asyncio.create_task(self.server.start())
         self.init_handlers()
+        self._lag_monitor = asyncio.create_task(
+            self.metrics.monitor_loop_lag(
+                self.cfg.get('metrics', dict()).get('lag_interval', 1.0)))
+        if self.queue is not None:
+            await self.queue.start()
+        for group in self.groups.values():
+            await group.start()
+        asyncio.create_task(self.server.start())
+
+    async def stop(self):
+        await self.server.stop()
+        if self.queue is not None:
+            await self.queue.stop()
+        for group in self.groups.values():
+            await group.stop()
+        if self._lag_monitor is not None:
+            self._lag_monitor.cancel()
 
     async def process_message(self,
                               message: Union[Confirmation,
                                              NewMessage]) -> Response:
-        self.logger.info('<-- recieved message: %s', message)
+        self.metrics.callbacks.inc(type(message).__name__)
+        if isinstance(message, NewMessage) and self.dedup.check(
+                self.dedup_key(message)):
+            self.logger.debug('duplicate message: %s', message)
+            self.metrics.deduplicated.inc()
+            return Response(text='ok')
+        self.message_logger.info('<-- recieved message: %s', message)
         if isinstance(message, Confirmation):
             return await self.process_confirmation_message(message)
         elif isinstance(message, NewMessage):
@@ -78,32 +162,111 @@ class Lina:
         else:
             raise ValueError
 
+    @staticmethod
+    def dedup_key(message: NewMessage) -> Tuple[Optional[int], int, int, int]:
+        return (message.group_id, message.peer_id,
+                message.conversation_message_id, message.id)
+
     async def process_confirmation_message(self,
-                                           _message: Confirmation) -> Response:
-        return Response(text=self.cfg['confirmation_code'])
+                                           message: Confirmation) -> Response:
+        return Response(text=self.get_group(message).confirmation_code)
 
     async def process_new_message(self, message: NewMessage) -> Response:
-        await self._process_new_message(message)
+        if message.action is not None and \
+                message.action.get('type') in MEMBERSHIP_ACTIONS:
+            self.get_api(message).members.invalidate(message.peer_id)
+        if self.queue is None:
+            await self._process_new_message(message)
+            return Response(text='ok')
+        try:
+            await self.queue.put(message)
+        except QueueOverflowException:
+            # not taken, so the redelivery must not look like a duplicate
+            self.dedup.forget(self.dedup_key(message))
+            return Response(status=503)  # VK will deliver it again later
         return Response(text='ok')
 
     async def _process_new_message(self, message: NewMessage) -> None:
-        if not re.search(self.regexp_mention, message.text):
+        regexp_mention = self.get_group(message).regexp_mention
+        if not re.search(regexp_mention, message.text):
             return  # message without bot mention
-        message.raw_text = re.sub(self.regexp_mention,
+        message.raw_text = re.sub(regexp_mention,
                                   '',
                                   message.text,
                                   count=1)
-        self.logger.info('raw text: %s', message.raw_text)
+        self.message_logger.info('raw text: %s', message.raw_text)
+        if self.flood is not None and \
+                message.from_id != self.cfg.get('admin_id'):
+            verdict = self.flood.check(message.from_id,
+                                       (message.group_id, message.peer_id))
+            if verdict is not Verdict.ALLOW:
+                self.metrics.throttled.inc(verdict.value)
+                self.logger.info('flood control: %s from %s in %s',
+                                 verdict.value, message.from_id,
+                                 message.peer_id)
+                if verdict is Verdict.NOTICE:
+                    try:
+                        await self.get_api(message).send_message(
+                            peer_id=message.peer_id,
+                            message=self.cfg['flood'].get(
+                                'notice_text',
+                                'Слишком много запросов, подождите немного'))
+                    except (VKException, ClientError,
+                            asyncio.TimeoutError) as e:
+                        self.logger.error('ERROR: %s', e)
+                return
         await self._handle_new_message(message)
 
     async def _handle_new_message(self, message: NewMessage):
-        for handler in self._handlers:
+        handlers = await self.dispatcher.dispatch(message)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.cfg['request_timeout']
+
+        def remaining() -> float:
+            return max(deadline - loop.time(), 0)
+
+        async def get_content(handler: BaseMessageHandler):
+            started = loop.time()
             try:
-                await handler.handler(message)
-            except VKException as e:
-                self.logger.error('ERROR: ', e)
-            except VkSendErrorException:
-                await self.api.send_error_sticker(message.peer_id)
+                return await handler.get_content(message)
+            finally:
+                self.metrics.handler_duration.observe(
+                    loop.time() - started, type(handler).__name__)
+
+        for handler in handlers:
+            self.metrics.triggered.inc(type(handler).__name__)
+        # content is prepared concurrently, replies go out in handler order
+        tasks = [asyncio.ensure_future(get_content(handler))
+                 for handler in handlers]
+        try:
+            for handler, task in zip(handlers, tasks):
+                try:
+                    content = await asyncio.wait_for(task, remaining())
+                    await asyncio.wait_for(
+                        handler.send_content(message, content), remaining())
+                except asyncio.TimeoutError:
+                    self.metrics.handler_timeouts.inc(type(handler).__name__)
+                    self.logger.error('Timeout error for message %s' %
+                                      message.raw_text)
+                    await self.send_error_sticker(message)
+                except VKException as e:
+                    self.logger.error('ERROR: %s', e)
+                except VkSendErrorException:
+                    await self.send_error_sticker(message)
+                except Exception:
+                    self.logger.exception('Error in %s for message %s',
+                                          type(handler).__name__,
+                                          message.raw_text)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def send_error_sticker(self, message: NewMessage):
+        try:
+            await self.get_api(message).send_error_sticker(message.peer_id)
+        except (VKException, ClientError, asyncio.TimeoutError) as e:
+            self.logger.error('ERROR: %s', e)
 
     async def add_handler(self, handler: BaseMessageHandler):
-        self._handlers.add(handler)
+        self._handlers.append(handler)
+        self.dispatcher = TriggerDispatcher(self._handlers)
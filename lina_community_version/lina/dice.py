@@ -0,0 +1,521 @@
+import heapq
+import os
+import re
+from array import array
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Match, Optional, \
+    Tuple, Union
+
+
+class DiceRoller:
+    # dice sides are drawn from unsigned words of the smallest fitting size
+    _word_formats = tuple((array(word_format).itemsize, word_format)
+                          for word_format in 'BHIQ')
+
+    def __init__(self,
+                 randbytes: Callable[[int], bytes] = os.urandom) -> None:
+        self.randbytes = randbytes
+
+    def roll(self, dice: int, amount: int) -> List[int]:
+        if dice < 1:
+            raise ValueError('dice must have at least one side')
+        if dice == 1:
+            return [1] * amount
+        for width, word_format in self._word_formats:
+            if dice <= 256 ** width:
+                break
+        else:
+            raise ValueError('too many sides: %s' % dice)
+        words = 256 ** width
+        # values above the last full multiple of dice are rejected,
+        # so every side has exactly the same probability
+        limit = words - words % dice
+        result: List[int] = list()
+        while len(result) < amount:
+            need = amount - len(result)
+            # ask for a bit more than the expected rejection rate
+            count = need * words // limit + 8
+            data = array(word_format, self.randbytes(count * width))
+            result.extend(value % dice + 1 for value in data if value < limit)
+        del result[amount:]
+        return result
+
+    @staticmethod
+    def keep(pool: List[int],
+             high_low: str,
+             count: int) -> Tuple[List[int], List[int]]:
+        if count > len(pool) // 32:
+            # a heap only pays off for a small part of the pool,
+            # both ways keep the earlier of equal dice
+            order = sorted(range(len(pool)), key=pool.__getitem__,
+                           reverse=high_low == 'h')
+            indexes = set(order[:count])
+        else:
+            select = heapq.nlargest if high_low == 'h' else heapq.nsmallest
+            indexes = set(select(count, range(len(pool)),
+                                 key=pool.__getitem__))
+        keep = list()
+        drop = list()
+        for index, item in enumerate(pool):
+            if index in indexes:
+                keep.append(item)
+            else:
+                drop.append(item)
+        return keep, drop
+
+    @staticmethod
+    def summary(pool: List[int]) -> str:
+        if not pool:
+            return '0 кубов'
+        return '%s кубов: мин %s, макс %s, среднее %.2f' % (
+            len(pool), min(pool), max(pool), sum(pool) / len(pool))
+
+
+EXPLODE_LIMIT = 100  # rerolls of exploding dice
+DEPTH_LIMIT = 16  # nested parentheses and unary minuses
+TOKEN_LIMIT = 256  # tokens of an expression
+TERM_LIMIT = 64  # numbers and dice in an expression
+START_LIMIT = 3  # start positions tried right before the first dice
+
+# A dice letter needs sides right after it and can not be a part of a word,
+# 'kh'/'kl' can follow the dice or any later term and keeps from that dice.
+_TOKEN = re.compile(r'''
+    (?P<dice>(?<![^\W\d_])(\d*)\s*[dдк](\d+)(!?)(?![^\W\d_kxх]))
+  | (?P<keep>k([hl])(\d*)(?![^\W\d_]))
+  | (?P<number>\d+)
+  | (?P<op>[-+*/xх])
+  | (?P<paren>[()])
+  | (?P<other>[^\s\d()+\-*/xхdдкk]+|\S)
+''', re.VERBOSE)
+
+_OPERATORS = {'+': '+', '-': '-', '*': '*', '/': '/', 'x': '*', 'х': '*'}
+
+Token = Tuple[str, Any]
+Value = Union[int, float]
+
+
+class DiceParseError(ValueError):
+    pass
+
+
+def join_pool(pool: List[int]) -> str:
+    return ' + '.join(map(str, pool))
+
+
+class RollContext:
+    def __init__(self,
+                 pools: Dict[int, List[int]],
+                 roll: Callable[[int, int], List[int]],
+                 pool_to_str: Callable[[List[int]], str],
+                 limit: Optional[int] = None) -> None:
+        self._pools = {sides: iter(pool) for sides, pool in pools.items()}
+        self.roll = roll
+        self.pool_to_str = pool_to_str
+        self.pools: List[List[int]] = list()
+        # dice rolled in total, exploding stops at the limit
+        self.limit = limit
+        self.rolled = 0
+
+    def take(self, sides: int, amount: int) -> List[int]:
+        self.rolled += amount
+        pool = list(islice(self._pools[sides], amount))
+        if len(pool) < amount:
+            pool.extend(self.roll(sides, amount - len(pool)))
+        return pool
+
+
+class Node:
+    def evaluate(self, context: RollContext) -> Tuple[Value, str]:
+        raise NotImplementedError
+
+    def iter_dice(self) -> Iterator['Dice']:
+        return iter(())
+
+
+class Number(Node):
+    def __init__(self, value: int) -> None:
+        self.value = value
+
+    def evaluate(self, context: RollContext) -> Tuple[Value, str]:
+        return self.value, str(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+
+class Dice(Node):
+    def __init__(self, amount: int, sides: int, explode: bool) -> None:
+        self.amount = amount
+        self.sides = sides
+        self.explode = explode
+        self.keep: Optional[Tuple[str, int]] = None
+
+    def iter_dice(self) -> Iterator['Dice']:
+        yield self
+
+    def evaluate(self, context: RollContext) -> Tuple[Value, str]:
+        pool = context.take(self.sides, self.amount)
+        if self.explode:
+            rolled = pool
+            for _ in range(EXPLODE_LIMIT):
+                again = rolled.count(self.sides)
+                if context.limit is not None:
+                    again = min(again, context.limit - context.rolled)
+                if again <= 0:
+                    break
+                context.rolled += again
+                rolled = context.roll(self.sides, again)
+                pool.extend(rolled)
+        context.pools.append(pool)
+        if self.keep is None:
+            return sum(pool), '(%s)' % context.pool_to_str(pool)
+        keep, drop = DiceRoller.keep(pool, *self.keep)
+        if not drop:
+            return sum(keep), '(%s)' % context.pool_to_str(keep)
+        return sum(keep), '(%s | %s)' % (context.pool_to_str(keep),
+                                         context.pool_to_str(drop))
+
+    def __str__(self):
+        text = '%sd%s%s' % (self.amount, self.sides, '!' if self.explode
+                            else '')
+        if self.keep is not None:
+            text += 'k%s%s' % self.keep
+        return text
+
+
+class Negative(Node):
+    def __init__(self, operand: Node) -> None:
+        self.operand = operand
+
+    def iter_dice(self) -> Iterator[Dice]:
+        return self.operand.iter_dice()
+
+    def evaluate(self, context: RollContext) -> Tuple[Value, str]:
+        value, text = self.operand.evaluate(context)
+        return -value, '-%s' % text
+
+    def __str__(self):
+        return '-%s' % self.operand
+
+
+class Parentheses(Node):
+    def __init__(self, inner: Node) -> None:
+        self.inner = inner
+
+    def iter_dice(self) -> Iterator[Dice]:
+        return self.inner.iter_dice()
+
+    def evaluate(self, context: RollContext) -> Tuple[Value, str]:
+        value, text = self.inner.evaluate(context)
+        return value, '[%s]' % text
+
+    def __str__(self):
+        return '(%s)' % self.inner
+
+
+def apply_operator(operator: str, left: Any, right: Any) -> Any:
+    if operator == '+':
+        return left + right
+    if operator == '-':
+        return left - right
+    if operator == '*':
+        return left * right
+    return left / right
+
+
+class BinaryOperation(Node):
+    def __init__(self, operator: str, left: Node, right: Node) -> None:
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def chain(self) -> Tuple[Node, List['BinaryOperation']]:
+        # a + b + c is nested on the left, it is walked in a loop so long
+        # chains do not recurse
+        operations: List[BinaryOperation] = list()
+        node: Node = self
+        while isinstance(node, BinaryOperation):
+            operations.append(node)
+            node = node.left
+        operations.reverse()
+        return node, operations
+
+    def iter_dice(self) -> Iterator[Dice]:
+        first, operations = self.chain()
+        yield from first.iter_dice()
+        for operation in operations:
+            yield from operation.right.iter_dice()
+
+    def evaluate(self, context: RollContext) -> Tuple[Value, str]:
+        first, operations = self.chain()
+        value, text = first.evaluate(context)
+        parts = [text]
+        for operation in operations:
+            right, right_text = operation.right.evaluate(context)
+            value = apply_operator(operation.operator, value, right)
+            parts.extend((operation.operator, right_text))
+        return value, ' '.join(parts)
+
+    def __str__(self):
+        first, operations = self.chain()
+        return str(first) + ''.join('%s%s' % (operation.operator,
+                                              operation.right)
+                                    for operation in operations)
+
+
+class DiceResult:
+    def __init__(self, value: Value, text: str, pools: List[List[int]]) \
+            -> None:
+        self.value = value
+        self.text = text
+        self.pools = pools
+
+    @property
+    def value_str(self) -> str:
+        if isinstance(self.value, float):
+            return format(self.value, '.2f')
+        return str(self.value)
+
+
+class DiceExpression:
+    def __init__(self, root: Node) -> None:
+        self.root = root
+        self.dice: Tuple[Dice, ...] = tuple(root.iter_dice())
+
+    @property
+    def amount(self) -> int:
+        return sum(dice.amount for dice in self.dice)
+
+    @property
+    def max_sides(self) -> int:
+        return max(dice.sides for dice in self.dice)
+
+    @property
+    def single_d20(self) -> bool:
+        return len(self.dice) == 1 and self.dice[0].amount == 1 and \
+            self.dice[0].sides == 20 and not self.dice[0].explode
+
+    def batches(self) -> Dict[int, int]:
+        # all dice with the same sides are rolled in one go
+        amounts: Dict[int, int] = dict()
+        for dice in self.dice:
+            amounts[dice.sides] = amounts.get(dice.sides, 0) + dice.amount
+        return amounts
+
+    def evaluate(self,
+                 pools: Dict[int, List[int]],
+                 roll: Callable[[int, int], List[int]],
+                 pool_to_str: Callable[[List[int]], str] = join_pool,
+                 limit: Optional[int] = None) -> DiceResult:
+        context = RollContext(pools, roll, pool_to_str, limit)
+        value, text = self.root.evaluate(context)
+        return DiceResult(value, text, context.pools)
+
+    def roll(self, roller: DiceRoller) -> DiceResult:
+        return self.evaluate({sides: roller.roll(sides, amount)
+                              for sides, amount in self.batches().items()},
+                             roller.roll)
+
+    def __str__(self):
+        return str(self.root)
+
+
+class DiceParser:
+    def __init__(self, tokens: List[Token]) -> None:
+        self.tokens = tokens
+        self.position = 0
+        self.depth = 0
+        self._dice: List[Dice] = list()
+        self._kept: List[Dice] = list()
+
+    @staticmethod
+    def token(match: Match[str]) -> Token:
+        kind = match.lastgroup or 'other'
+        if kind == 'dice':
+            amount, sides, explode = match.group(2, 3, 4)
+            return kind, (int(amount) if amount else 1, int(sides),
+                          explode == '!')
+        if kind == 'keep':
+            high_low, count = match.group(6, 7)
+            return kind, (high_low, int(count) if count else 1)
+        if kind == 'number':
+            return kind, int(match.group())
+        if kind == 'op':
+            return kind, _OPERATORS[match.group()]
+        return kind, match.group()
+
+    @classmethod
+    def expression_tokens(cls, text: str) -> Optional[Tuple[Token, ...]]:
+        # the run of tokens that holds the first dice, other text can not
+        # be inside of an expression
+        run: List[Token] = list()
+        too_long = False
+        has_dice = False
+        for match in _TOKEN.finditer(text):
+            token = cls.token(match)
+            if token[0] == 'other':
+                if has_dice:
+                    break
+                run = list()
+                too_long = False
+                continue
+            if token[0] == 'dice':
+                if too_long:
+                    return None
+                has_dice = True
+            if len(run) < TOKEN_LIMIT:
+                run.append(token)
+            elif has_dice:
+                return None
+            else:
+                too_long = True
+        return tuple(run) if has_dice else None
+
+    def peek(self) -> Optional[Token]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def expect(self, kind: str, value: Any = None) -> Any:
+        token = self.peek()
+        if token is None or token[0] != kind or \
+                value is not None and token[1] != value:
+            raise DiceParseError('unexpected %s' % (token,))
+        self.position += 1
+        return token[1]
+
+    def parse(self) -> Optional[DiceExpression]:
+        # the expression starts where the other text ends or right before
+        # the first dice, and ends where the text stops looking like one
+        first_dice = next((index for index, (kind, _)
+                           in enumerate(self.tokens) if kind == 'dice'),
+                          None)
+        if first_dice is None:
+            return None
+        # other text can not be inside of an expression
+        first_start = first_dice
+        while first_start and self.tokens[first_start - 1][0] != 'other':
+            first_start -= 1
+        if len(self.tokens) - first_start > TOKEN_LIMIT or \
+                sum(kind in ('number', 'dice') for kind, _
+                    in self.tokens[first_start:]) > TERM_LIMIT:
+            return None
+        starts = sorted({first_start} | set(range(
+            max(first_start, first_dice - START_LIMIT + 1), first_dice + 1)))
+        for start in starts:
+            self.position = start
+            self.depth = 0
+            self._dice = list()
+            self._kept = list()
+            try:
+                root = self.parse_sum()
+            except (DiceParseError, RecursionError):
+                continue
+            if self._dice:
+                return DiceExpression(root)
+        return None
+
+    def _binary(self,
+                operators: Tuple[str, ...],
+                operand: Callable[[], Node]) -> Node:
+        node = operand()
+        while True:
+            token = self.peek()
+            if token is None or token[0] != 'op' or \
+                    token[1] not in operators:
+                return node
+            state = self.position, len(self._dice), len(self._kept)
+            self.position += 1
+            try:
+                node = BinaryOperation(token[1], node, operand())
+            except DiceParseError:
+                self._rollback(*state)  # trailing text, not an operand
+                return node
+
+    def _rollback(self, position: int, dice: int, kept: int):
+        self.position = position
+        del self._dice[dice:]
+        for node in self._kept[kept:]:
+            node.keep = None
+        del self._kept[kept:]
+
+    def parse_sum(self) -> Node:
+        return self._binary(('+', '-'), self.parse_product)
+
+    def parse_product(self) -> Node:
+        return self._binary(('*', '/'), self.parse_unary)
+
+    def parse_unary(self) -> Node:
+        negations = 0
+        while self.peek() == ('op', '-'):
+            negations += 1
+            if self.depth + negations > DEPTH_LIMIT:
+                raise DiceParseError('too deep')
+            self.position += 1
+        if negations:
+            self.depth += negations
+            try:
+                node = self.parse_unary()
+            finally:
+                self.depth -= negations
+            for _ in range(negations):
+                node = Negative(node)
+            return node
+        node = self.parse_primary()
+        token = self.peek()
+        if token is not None and token[0] == 'keep':
+            if not self._dice or self._dice[-1].keep is not None:
+                raise DiceParseError('nothing to keep from')
+            self.position += 1
+            high_low, count = token[1]
+            if count:
+                self._dice[-1].keep = high_low, count
+                self._kept.append(self._dice[-1])
+        return node
+
+    def parse_primary(self) -> Node:
+        token = self.peek()
+        if token is None:
+            raise DiceParseError('unexpected end')
+        kind, value = token
+        if kind == 'number':
+            self.position += 1
+            return Number(value)
+        if kind == 'dice':
+            self.position += 1
+            dice = Dice(*value)
+            self._dice.append(dice)
+            return dice
+        if token == ('paren', '('):
+            if self.depth >= DEPTH_LIMIT:
+                raise DiceParseError('too deep')
+            self.position += 1
+            self.depth += 1
+            try:
+                inner = self.parse_sum()
+                self.expect('paren', ')')
+            finally:
+                self.depth -= 1
+            return Parentheses(inner)
+        raise DiceParseError('unexpected %s' % (token,))
+
+
+_DICE_HINT = re.compile(r'[dдк]\d')
+
+
+@lru_cache(maxsize=512)
+def compile_dice(tokens: Tuple[Token, ...]) -> Optional[DiceExpression]:
+    return DiceParser(list(tokens)).parse()
+
+
+def parse_dice(text: str) -> Optional[DiceExpression]:
+    # Chat without dice never reaches the cache, and the key is the tokens
+    # of the expression alone, so 'кидаю 2d6 + 1' and '2д6+1 за урон'
+    # share one entry.
+    if _DICE_HINT.search(text) is None:
+        return None
+    tokens = DiceParser.expression_tokens(text)
+    if tokens is None:
+        return None
+    return compile_dice(tokens)
@@ -1,13 +1,14 @@
 import re
-from asyncio import wait_for, sleep, TimeoutError
+from asyncio import get_event_loop, sleep
 from itertools import chain
-from random import SystemRandom, choice
-from typing import Optional, TYPE_CHECKING, Pattern, List, Tuple
+from typing import Optional, TYPE_CHECKING, Pattern, List, Tuple, Dict
 
 from lina_community_version.core.handlers import BaseMessageHandler
 from lina_community_version.core.messages import NewMessage
 from lina_community_version.core.exceptions import VkSendErrorException, \
     VKException, ErrorCodes
+from lina_community_version.lina.dice import Dice, DiceRoller, parse_dice
+from lina_community_version.lina.stats import TooComplexError, dice_stats
 
 if TYPE_CHECKING:
     from lina_community_version.lina.bot import Lina
@@ -18,33 +19,28 @@ class LinaNewMessageHandler(BaseMessageHandler):
         self.service = service
 
     trigger_word: Optional[str] = None
+    triggers: Tuple[str, ...] = tuple()
 
-    async def handler(self, message: NewMessage):
-        timeout_error = self.service.cfg['request_timeout']
-        try:
-            await wait_for(super().handler(message), timeout=timeout_error)
-        except TimeoutError:
-            self.service.logger.error('Timeout error for message %s' %
-                                      message.raw_text)
-            raise VkSendErrorException
+    def get_triggers(self) -> Tuple[str, ...]:
+        if self.trigger_word is None:
+            return self.triggers
+        return (self.trigger_word,) + self.triggers
 
     async def is_triggered(self, message: NewMessage) -> bool:
-        if self.trigger_word is None or message.raw_text is None:
+        if message.raw_text is None:
             return False
         else:
-            return self.trigger_word in message.raw_text
+            return any(keyword in message.raw_text
+                       for keyword in self.get_triggers())
 
-    async def _handler(self, message: NewMessage):
+    async def send_content(self, message: NewMessage, content):
         try:
-            content = await self.get_content(message)
             if isinstance(content, tuple):
-                for one_message in content:
-                    await self.service.api.send_message(
-                        peer_id=message.peer_id,
-                        message=one_message)
-                    await sleep(1)
+                await self.service.get_api(message).send_messages(
+                    peer_id=message.peer_id,
+                    messages=content)
             elif isinstance(content, str):
-                await self.service.api.send_message(
+                await self.service.get_api(message).send_message(
                     peer_id=message.peer_id,
                     message=content)
         except VKException as e:
@@ -66,7 +62,7 @@ class SimpleDiceMessageHandler(LinaNewMessageHandler):
     trigger_word = 'дайс'
 
     async def get_content(self, _message: NewMessage):
-        result = SystemRandom().randint(1, 20)
+        result = self.service.random.randint(1, 20)
         return 'тупо 20' if result == 20 else str(result)
 
 
@@ -78,111 +74,135 @@ class RaiseErrorMessageHandler(LinaNewMessageHandler):
 
 
 class RegexpDiceMessageHandler(LinaNewMessageHandler):
-    pattern: Pattern[str] = re.compile(
-        r'(^|[\d\s]+)[dдк](\d+)\s*([xх/*+-]\d+)?\s*(k([h|l])(\d*))?')
+    roll_chunk = 65536
+
+    def __init__(self, service: 'Lina') -> None:
+        super().__init__(service)
+        self.roller = DiceRoller(service.random.randbytes)
 
     async def is_triggered(self, message: NewMessage) -> bool:
         if message.raw_text is not None:
-            result = self.pattern.search(message.raw_text) is not None
-            return result
+            if any(trigger in message.raw_text
+                   for trigger in DiceStatsMessageHandler.triggers):
+                return False  # odds are asked, not a roll
+            return parse_dice(message.raw_text) is not None
         else:
             raise VkSendErrorException
 
-    @staticmethod
-    def cast_amount(amount: str) -> int:
-        amount = amount.strip()
-        return int(amount) if amount != '' else 1
+    @property
+    def dice_cfg(self) -> dict:
+        return self.service.cfg.get('dice', dict())
 
     async def get_dice_pool(self, dice: int, amount: int) -> List[int]:
-        result = list()
-        for i in range(amount * 2):
-            result.append(self.get_dice(dice))
+        result: List[int] = list()
+        while len(result) < amount:
+            result.extend(self.roller.roll(
+                dice, min(self.roll_chunk, amount - len(result))))
             await sleep(0)
-        self.service.logger.info(result)
-        SystemRandom().shuffle(result)
-        return result[:amount]
-
-    def get_dice(self, dice: int) -> int:
-        result = SystemRandom().randint(1, dice)
+        limit = self.dice_cfg.get('log_pool_limit', 100)
+        if len(result) > limit:
+            self.service.message_logger.info(
+                '%s ... (%s dice)', result[:limit], len(result))
+        else:
+            self.service.message_logger.info(result)
         return result
 
     @staticmethod
     def get_khl(pool: List[int],
                 high_low: str,
                 high_low_count: int) -> Tuple[List[int], List[int]]:
-        indexes = (sorted(range(len(pool)),
-                          key=pool.__getitem__,
-                          reverse=high_low == 'h'))[:high_low_count]
-        keep = list()
-        drop = list()
-        for index, item in enumerate(pool):
-            if index in indexes:
-                keep.append(item)
-            else:
-                drop.append(item)
-        return keep, drop
+        return DiceRoller.keep(pool, high_low, high_low_count)
 
-    @staticmethod
-    def pool_to_str(pool: List[int]) -> str:
+    def pool_to_str(self, pool: List[int]) -> str:
+        if len(pool) > self.dice_cfg.get('summary_threshold', 100):
+            return self.roller.summary(pool)
         return ' + '.join(map(str, pool))
 
     async def get_content(self, message: NewMessage):
-        if message.raw_text is not None:
-            parse_result = self.pattern.findall(message.raw_text)
-            amount: int = self.cast_amount(parse_result[0][0])
-            dice: int = int(parse_result[0][1])
-            modifier: str = parse_result[0][2]
-            khl = parse_result[0][4]
-            try:
-                khl_count = int(parse_result[0][5])
-            except ValueError:
-                khl_count = 1
-            if amount < 1 or dice < 1:
-                raise VkSendErrorException
-            dice_pool: List[int] = await self.get_dice_pool(dice, amount)
-            if khl and khl_count:
-                pool_keep, pool_drop = self.get_khl(dice_pool, khl, khl_count)
-                pool_result_int = sum(pool_keep)
-                if not len(pool_drop):
-                    pool_result_str = self.pool_to_str(pool_keep)
-                else:
-                    pool_result_str = f'{self.pool_to_str(pool_keep)} | ' \
-                                      f'{self.pool_to_str(pool_drop)}'
-            else:
-                pool_result_str = self.pool_to_str(dice_pool)
-                pool_result_int = sum(dice_pool)
-            number_modifier = int(modifier[1:]) if modifier != '' else 0
-            if modifier.startswith('+'):
-                throw_result = str(pool_result_int + number_modifier)
-            elif modifier.startswith('-'):
-                throw_result = str(pool_result_int - number_modifier)
-            elif modifier.startswith('/'):
-                throw_result = format(pool_result_int / number_modifier, '.2f')
-            elif modifier.startswith(('x', 'х', '*')):
-                throw_result = str(pool_result_int * number_modifier)
-            else:
-                throw_result = str(pool_result_int)
+        if message.raw_text is None:
+            raise VkSendErrorException
+        expression = parse_dice(message.raw_text)
+        if expression is None:
+            raise VkSendErrorException
+        # a one sided dice would explode on every roll
+        if any(dice.amount < 1 or dice.sides < 1 or
+               dice.explode and dice.sides < 2
+               for dice in expression.dice):
+            raise VkSendErrorException
+        max_amount = self.dice_cfg.get('max_amount', 100000)
+        if expression.amount > max_amount or \
+                expression.max_sides > self.dice_cfg.get('max_sides',
+                                                         1000000):
+            raise VkSendErrorException
+        pools: Dict[int, List[int]] = dict()
+        for dice, amount in expression.batches().items():
+            pools[dice] = await self.get_dice_pool(dice, amount)
+        try:
+            result = expression.evaluate(pools,
+                                         self.roller.roll,
+                                         self.pool_to_str,
+                                         limit=max_amount)
+        except ZeroDivisionError:
+            raise VkSendErrorException
+        if expression.single_d20 and result.pools[0] == [20]:
+            if isinstance(expression.root, Dice):
+                return 'тупо 20'
+            return 'тупо 20: %s = %s' % (result.text, result.value_str)
+        return '%s = %s' % (result.text, result.value_str)
 
-            if amount == 1 and dice == 20 and pool_result_int == 20:
-                return 'тупо 20 %s %s' % (modifier,
-                                          ('= %s' % throw_result)
-                                          if modifier != '' else '')
 
-            result = '(%s) %s = %s' % (pool_result_str,
-                                      modifier,
-                                      throw_result)
-            return result
-        else:
+class DiceStatsMessageHandler(LinaNewMessageHandler):
+    triggers = ('шансы', 'вероятность')
+    comparison: Pattern[str] = re.compile(
+        r'(>=|≥|<=|≤|>|<|=)\s*(-?\d+(?:[.,]\d+)?)')
+
+    async def get_content(self, message: NewMessage):
+        if message.raw_text is None:
+            raise VkSendErrorException
+        match = self.comparison.search(message.raw_text)
+        expression = parse_dice(message.raw_text[:match.start()]
+                                if match else message.raw_text)
+        if expression is None:
+            return 'Не вижу броска. Пример: "Лина шансы 4д6 kh3 >= 15"'
+        dice_cfg = self.service.cfg.get('dice', dict())
+        if expression.amount > dice_cfg.get('max_amount', 100000) or \
+                expression.max_sides > dice_cfg.get('max_sides', 1000000):
             raise VkSendErrorException
+        try:
+            # heavy distributions should not stall the event loop
+            stats = await get_event_loop().run_in_executor(
+                None, dice_stats, str(expression))
+        except TooComplexError:
+            return 'Слишком сложный бросок, точно посчитать не получится'
+        except ZeroDivisionError:
+            raise VkSendErrorException
+        lines = ['%s: от %s до %s, среднее %.2f' % (
+            expression, self.format_value(stats.minimum),
+            self.format_value(stats.maximum), stats.mean),
+            'процентили: %s' % ', '.join(
+                '%s%% - %s' % (share, self.format_value(value))
+                for share, value in stats.percentiles.items())]
+        if match:
+            comparison, target = match.groups()
+            lines.append('P(%s %s) = %.2f%%' % (
+                comparison, target, 100 * stats.probability(
+                    comparison, float(target.replace(',', '.')))))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def format_value(value) -> str:
+        if isinstance(value, float):
+            return format(value, '.2f')
+        return str(value)
 
 
 class MeowMessageHandler(LinaNewMessageHandler):
     trigger_word = 'мяу'
 
-    async def _handler(self, message: NewMessage):
-        await self.service.api.send_sticker(
+    async def send_content(self, message: NewMessage, content):
+        await self.service.get_api(message).send_sticker(
             peer_id=message.peer_id,
-            sticker_id=await self.get_content(message))
+            sticker_id=content)
 
     async def get_content(self, message: NewMessage):
         peachy_ids = range(49, 97)
@@ -204,7 +224,7 @@ class MeowMessageHandler(LinaNewMessageHandler):
                                         snow_id,
                                         earl,
                                         tabby)]
-        return SystemRandom().choice(cats_id)
+        return self.service.random.choice(cats_id)
 
 
 class WhereArePostsMessageHandler(LinaNewMessageHandler):
@@ -218,14 +238,14 @@ class WhereArePostsMessageHandler(LinaNewMessageHandler):
     ]
 
     async def get_content(self, message: NewMessage):
-        return SystemRandom().choice(self.answers)
+        return self.service.random.choice(self.answers)
 
 
 class InfoMessageHandler(LinaNewMessageHandler):
     trigger_word = 'инфа'
 
     async def get_content(self, message: NewMessage):
-        info = SystemRandom().randint(1, 101)
+        info = self.service.random.randint(1, 101)
         if info == 100:
             return 'инфа сотка'
         elif info == 101:
@@ -257,18 +277,19 @@ class WhoIsGuiltyMessageHandler(LinaNewMessageHandler):
     ]
 
     async def get_content(self, message: NewMessage):
-        if SystemRandom().randint(1, 10) == 1:
+        if self.service.random.randint(1, 10) == 1:
             try:
-                maybe_guilty = await self.service.api.get_conversation_members(
-                    message.peer_id)
-                return 'Это %s во всем виноват' % choice(maybe_guilty)
+                maybe_guilty = await self.service.get_api(
+                    message).get_conversation_members(message.peer_id)
+                return 'Это %s во всем виноват' % self.service.random.choice(
+                    maybe_guilty)
             except VKException as e:
                 if e.code == ErrorCodes.ADMIN_PERMISSION_REQUIRED.value:
                     self.service.logger.warn(
                         'code %s, Admin permissions required!' % e.code)
                 else:
                     raise e
-        return SystemRandom().choice(self.guilty)
+        return self.service.random.choice(self.guilty)
 
 
 class WhoIsChosenMessageHandler(LinaNewMessageHandler):
@@ -279,9 +300,9 @@ class WhoIsChosenMessageHandler(LinaNewMessageHandler):
         if message.peer_id < self.conference_id_modifier:
             return 'Ты избран, здесь же больше никого нет'
         try:
-            chosen_one = await self.service.api.get_conversation_members(
-                message.peer_id)
-            return '%s, ты избран!' % SystemRandom().choice(chosen_one)
+            chosen_one = await self.service.get_api(
+                message).get_conversation_members(message.peer_id)
+            return '%s, ты избран!' % self.service.random.choice(chosen_one)
         except VKException as e:
             self.service.logger.error(e)
             if e.code == ErrorCodes.ADMIN_PERMISSION_REQUIRED.value:
@@ -300,7 +321,7 @@ class IntervalRandomMessageHandler(LinaNewMessageHandler):
                 _min, _max = map(lambda x: int(x), parse_result[0])
                 if _min > _max:
                     _min, _max = _max, _min
-                result = SystemRandom().randint(_min, _max)
+                result = self.service.random.randint(_min, _max)
                 return 'от %s до %s: %s' % (_min, _max, result)
             except (IndexError, ValueError):
                 return
@@ -324,9 +345,10 @@ class SayHelloMessageHandler(LinaNewMessageHandler):
         if message.from_id == self.service.cfg['admin_id']:
             return 'Привет, мастер!'
         elif message.from_id in self.unique_hellos:
-            return SystemRandom().choice(self.unique_hellos[message.from_id])
+            return self.service.random.choice(
+                self.unique_hellos[message.from_id])
         else:
-            return SystemRandom().choice(self.hellos)
+            return self.service.random.choice(self.hellos)
 
 
 class LoveYouMessageHandler(LinaNewMessageHandler):
@@ -335,18 +357,11 @@ class LoveYouMessageHandler(LinaNewMessageHandler):
                   'Я тоже тебя люблю, как брата',
                   'Ты очень хороший друг']
 
-    async def is_triggered(self, message: NewMessage) -> bool:
-        if message.raw_text is not None:
-            return any(keyword in message.raw_text
-                       for keyword in self.triggers)
-        else:
-            return False
-
     async def get_content(self, message: NewMessage):
         if message.from_id == self.service.cfg['admin_id']:
             return 'Я тоже тебя люблю <3'
         elif message.from_id in self.service.cfg['friend_zone']:
-            return SystemRandom().choice(self.friendzone)
+            return self.service.random.choice(self.friendzone)
         else:
             return 'А я тебя нет'
 
@@ -355,7 +370,7 @@ class AlternateMessageHandler(LinaNewMessageHandler):
     trigger_word = ' или '
 
     async def get_content(self, message: NewMessage):
-        return SystemRandom().choice(
+        return self.service.random.choice(
             self.maybe_clear_raw_text(message).split(' или '))
 
     @staticmethod
@@ -373,7 +388,7 @@ class CoinMessageHandler(LinaNewMessageHandler):
     trigger_word = 'монетка'
 
     async def get_content(self, message: NewMessage):
-        result = SystemRandom().randint(1, 100)
+        result = self.service.random.randint(1, 100)
         if 99 < result <= 100:
             return 'Монетка взорвалась и убила тебя'
         if 96 < result <= 99:
@@ -389,13 +404,6 @@ class CoinMessageHandler(LinaNewMessageHandler):
 class HelpMessageHandler(LinaNewMessageHandler):
     triggers = ('help', 'помощь')
 
-    async def is_triggered(self, message: NewMessage) -> bool:
-        if message.raw_text is not None:
-            return any(keyword in message.raw_text
-                       for keyword in self.triggers)
-        else:
-            return False
-
     async def get_content(self, message: NewMessage):
         return (
             'Бот реагирует на команды в двух случаях: \r\n'
@@ -411,7 +419,12 @@ class HelpMessageHandler(LinaNewMessageHandler):
             'Пример: "Лина 3д6"\r\n '
             'Помимо обычного броска можно к броску прибавлять (+), '
             'отнимать (-), умножать (x - русская и английская раскладка), '
-            'и делить (/) на определенный модификатор.\r\n\r\n'
+            'и делить (/) на определенный модификатор, а также '
+            'складывать несколько бросков и ставить скобки.\r\n '
+            'Пример: "Лина (2d6 + 1d4) x2 + 3"\r\n '
+            'Восклицательный знак после броска - взрывающиеся кубы: '
+            'каждый максимальный результат добавляет еще один куб.\r\n '
+            'Пример: "Лина 3д6!"\r\n\r\n'
             'БРОСКИ С ПРЕИМУЩЕСТВОМ И ПОМЕХОЙ:\r\n '
             'Чтобы выбрать наибольшее значение из нескольких кубов, '
             'можно добавить необязательную команду kh (keep high). \r\n'
@@ -422,10 +435,12 @@ class HelpMessageHandler(LinaNewMessageHandler):
             'для этого после kh/kl добавляется число\r\n'
             'Пример: Лина 5д6 kl3 - бросить 5d6 и выбрать три наименьших '
             'из них\r\n'
-            'ВАЖНО: Если у броска есть модификатор, он должен быть применен '
-            'раньше, чем kh/kl.\r\n '
-            'Лина 2д20 +1 kh - будет работать. \r\n'
-            'Лина 2д20 kh +1 - модификатор не будет учтен\r\n\r\n'
+            'kh/kl относится к ближайшему броску перед ним, '
+            'поэтому "Лина 2д20 kh +1" и "Лина 2д20 +1 kh" '
+            'работают одинаково\r\n\r\n'
+            'ШАНСЫ:\r\n '
+            '"Лина шансы 4д6 kh3 >= 15" - точное распределение броска: '
+            'среднее, процентили и вероятность условия\r\n\r\n'
             'ДРУГИЕ КОМАНДЫ: \r\n\r\n'
             '"Дайс" - синоним для команды 1d20\r\n\r\n '
             '"Рандом от X до Y" - Лина случайным образом '
@@ -474,4 +489,4 @@ class Magic8BallMessageHangler(LinaNewMessageHandler):
     ]
 
     async def get_content(self, message: NewMessage):
-        return SystemRandom().choice(self.ball_answers)
+        return self.service.random.choice(self.ball_answers)
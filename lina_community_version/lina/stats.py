@@ -0,0 +1,288 @@
+from bisect import bisect_left
+from functools import lru_cache
+from math import exp, lgamma, log
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from lina_community_version.lina.dice import BinaryOperation, Dice, \
+    EXPLODE_LIMIT, Negative, Node, Number, Parentheses, apply_operator, \
+    parse_dice
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # type: ignore
+
+Value = Union[int, float]
+
+# outcomes a distribution may have, plain python is much slower
+MAX_SUPPORT = 200000 if numpy is not None else 20000
+MAX_POINTS = 100000  # outcome pairs for * and / of two random values
+MAX_KEEP_WORK = 5 * 10 ** 7  # steps of the keep highest table
+EXPLODE_EPSILON = 1e-12  # exploding dice tail that is left out
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class TooComplexError(ValueError):
+    pass
+
+
+def _zeros(size: int):
+    if numpy is not None:
+        return numpy.zeros(size)
+    return [0.0] * size
+
+
+def _add_into(target, start: int, source, weight: float = 1.0):
+    if numpy is not None:
+        target[start:start + len(source)] += numpy.asarray(source) * weight
+        return
+    target[start:start + len(source)] = [
+        value + item * weight
+        for value, item in zip(target[start:start + len(source)], source)]
+
+
+def convolve(left: Sequence[float], right: Sequence[float]):
+    if numpy is not None:
+        size = len(left) + len(right) - 1
+        if len(left) * len(right) < 10 ** 6:
+            return numpy.convolve(left, right)
+        # large supports go through fft, rounding noise is clipped
+        result = numpy.fft.irfft(numpy.fft.rfft(left, size) *
+                                 numpy.fft.rfft(right, size), size)
+        return numpy.clip(result, 0, None)
+    if len(left) < len(right):
+        left, right = right, left
+    result = _zeros(len(left) + len(right) - 1)
+    for shift, weight in enumerate(right):
+        if weight:
+            _add_into(result, shift, left, weight)
+    return result
+
+
+class Distribution:
+    # Integer outcomes are kept as probabilities of offset, offset + 1, ...
+    # so sums are convolutions. Products and quotients fall back to points.
+    def __init__(self,
+                 offset: int = 0,
+                 probs: Optional[Sequence[float]] = None,
+                 points: Optional[Dict[Value, float]] = None) -> None:
+        self.offset = offset
+        self.probs = probs
+        self.points = points
+
+    @classmethod
+    def constant(cls, value: int) -> 'Distribution':
+        return cls(value, [1.0])
+
+    @property
+    def size(self) -> int:
+        if self.points is not None:
+            return len(self.points)
+        assert self.probs is not None
+        return len(self.probs)
+
+    def items(self) -> List[Tuple[Value, float]]:
+        if self.points is not None:
+            return sorted(self.points.items())
+        assert self.probs is not None
+        return [(self.offset + index, float(prob))
+                for index, prob in enumerate(self.probs) if prob > 0]
+
+    def __neg__(self) -> 'Distribution':
+        if self.points is not None:
+            return Distribution(points={-value: prob for value, prob
+                                        in self.points.items()})
+        assert self.probs is not None
+        return Distribution(-(self.offset + len(self.probs) - 1),
+                            self.probs[::-1])
+
+    def __add__(self, other: 'Distribution') -> 'Distribution':
+        if self.points is None and other.points is None:
+            assert self.probs is not None and other.probs is not None
+            if len(self.probs) + len(other.probs) > MAX_SUPPORT:
+                raise TooComplexError
+            return Distribution(self.offset + other.offset,
+                                convolve(self.probs, other.probs))
+        return self._combine(other, lambda a, b: a + b)
+
+    def __sub__(self, other: 'Distribution') -> 'Distribution':
+        return self + -other
+
+    def __mul__(self, other: 'Distribution') -> 'Distribution':
+        return self._combine(other, lambda a, b: a * b)
+
+    def __truediv__(self, other: 'Distribution') -> 'Distribution':
+        return self._combine(other, lambda a, b: a / b)
+
+    def _combine(self, other: 'Distribution', operation) -> 'Distribution':
+        if self.size * other.size > MAX_POINTS:
+            raise TooComplexError
+        points: Dict[Value, float] = dict()
+        for left, left_prob in self.items():
+            for right, right_prob in other.items():
+                value = operation(left, right)
+                points[value] = points.get(value, 0.0) + left_prob * right_prob
+        return Distribution(points=points)
+
+    def power(self, times: int) -> 'Distribution':
+        # sum of independent copies by repeated squaring
+        result = Distribution.constant(0)
+        square = self
+        while times:
+            if times & 1:
+                result = result + square
+            times >>= 1
+            if times:
+                square = square + square
+        return result
+
+
+def single_die(sides: int, explode: bool) -> Distribution:
+    if not explode:
+        return Distribution(1, [1.0 / sides] * sides)
+    if sides < 2:
+        raise TooComplexError
+    # every maximum adds one more die, deep rerolls are too unlikely to count
+    depth = 0
+    while depth < EXPLODE_LIMIT and sides ** -(depth + 1) > EXPLODE_EPSILON:
+        depth += 1
+    probs = _zeros((depth + 1) * sides)
+    for level in range(depth + 1):
+        chance = float(sides) ** -(level + 1)
+        faces = sides if level == depth else sides - 1
+        for face in range(faces):
+            probs[level * sides + face] = chance
+    return Distribution(1, probs)
+
+
+def keep_highest(amount: int, sides: int, count: int) -> Distribution:
+    # Faces are assigned from the highest down: table[placed] holds the
+    # probability weights of kept sums once 'placed' dice are higher.
+    if sides * (amount + 1) ** 2 * count * sides > MAX_KEEP_WORK:
+        raise TooComplexError
+    chance = 1.0 / sides
+    table: Dict[int, Any] = {0: [1.0]}
+    for face in range(sides, 0, -1):
+        updated: Dict[int, Any] = dict()
+        for placed, sums in table.items():
+            left = amount - placed
+            # the lowest face takes all remaining dice
+            counts = range(left + 1) if face > 1 else (left,)
+            for number in counts:
+                kept = min(placed + number, count) - min(placed, count)
+                # binomial weight in logs, big tables overflow floats
+                weight = exp(lgamma(left + 1) - lgamma(number + 1) -
+                             lgamma(left - number + 1) +
+                             number * log(chance))
+                size = len(sums) + kept * face
+                target = updated.get(placed + number)
+                if target is None or len(target) < size:
+                    grown = _zeros(size)
+                    if target is not None:
+                        _add_into(grown, 0, target)
+                    target = updated[placed + number] = grown
+                _add_into(target, kept * face, sums, weight)
+        table = updated
+    # the weights are indexed by kept sum, which starts at count
+    return Distribution(count, table[amount][count:])
+
+
+def dice_distribution(dice: Dice) -> Distribution:
+    if dice.amount < 1 or dice.sides < 1:
+        raise TooComplexError
+    if dice.keep is None or dice.keep[1] >= dice.amount:
+        if dice.amount * dice.sides > MAX_SUPPORT:
+            raise TooComplexError
+        return single_die(dice.sides, dice.explode).power(dice.amount)
+    if dice.explode:
+        raise TooComplexError
+    high_low, count = dice.keep
+    result = keep_highest(dice.amount, dice.sides, count)
+    if high_low == 'l':
+        # keeping the lowest is keeping the highest of mirrored faces
+        assert result.probs is not None
+        return Distribution(count, result.probs[::-1])
+    return result
+
+
+def distribution(node: Node) -> Distribution:
+    if isinstance(node, Number):
+        return Distribution.constant(node.value)
+    if isinstance(node, Dice):
+        return dice_distribution(node)
+    if isinstance(node, Negative):
+        return -distribution(node.operand)
+    if isinstance(node, Parentheses):
+        return distribution(node.inner)
+    if isinstance(node, BinaryOperation):
+        first, operations = node.chain()
+        result = distribution(first)
+        for operation in operations:
+            result = apply_operator(operation.operator, result,
+                                    distribution(operation.right))
+        return result
+    raise TooComplexError
+
+
+class DiceStats:
+    def __init__(self, result: Distribution) -> None:
+        items = result.items()
+        total = sum(prob for _, prob in items)
+        self.values = [value for value, _ in items]
+        self.probs = [prob / total for _, prob in items]
+        self.mean = sum(value * prob for value, prob
+                        in zip(self.values, self.probs))
+        # tail[i] is the chance to get values[i] or more
+        self.tail: List[float] = list()
+        remaining = 1.0
+        for prob in self.probs:
+            self.tail.append(max(remaining, 0.0))
+            remaining -= prob
+        self.percentiles = {share: self.percentile(share / 100)
+                            for share in PERCENTILES}
+
+    @property
+    def minimum(self) -> Value:
+        return self.values[0]
+
+    @property
+    def maximum(self) -> Value:
+        return self.values[-1]
+
+    def percentile(self, share: float) -> Value:
+        cumulative = 0.0
+        for value, prob in zip(self.values, self.probs):
+            cumulative += prob
+            if cumulative >= share - 1e-12:
+                return value
+        return self.values[-1]
+
+    def at_least(self, target: float) -> float:
+        index = bisect_left(self.values, target)
+        return self.tail[index] if index < len(self.tail) else 0.0
+
+    def probability(self, comparison: str, target: float) -> float:
+        if comparison in ('>=', '≥'):
+            return self.at_least(target)
+        if comparison == '>':
+            return self.at_least(target) - self.exactly(target)
+        if comparison in ('<=', '≤'):
+            return 1.0 - self.at_least(target) + self.exactly(target)
+        if comparison == '<':
+            return 1.0 - self.at_least(target)
+        return self.exactly(target)
+
+    def exactly(self, target: float) -> float:
+        index = bisect_left(self.values, target)
+        if index < len(self.values) and self.values[index] == target:
+            return self.probs[index]
+        return 0.0
+
+
+@lru_cache(maxsize=256)
+def dice_stats(expression: str) -> DiceStats:
+    # keyed by the canonical form, so '4д6 kh3' and '4d6kh3' share a result
+    compiled = parse_dice(expression)
+    if compiled is None:
+        raise ValueError('not a dice expression: %s' % expression)
+    return DiceStats(distribution(compiled.root))
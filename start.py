@@ -1,14 +1,37 @@
 import asyncio
+import signal
+from functools import partial
 
+from lina_community_version.core.supervisor import Supervisor
 from lina_community_version.lina.bot import Lina
 from lina_community_version.lina.handlers import LinaNewMessageHandler
 
-async def main():
-    lina = Lina()
+
+async def main(lina: Lina):
     lina.setup_handler_class(LinaNewMessageHandler)
     await lina.start()
 
+
+def run(lina: Lina):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main(lina))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    loop.run_forever()
+    loop.run_until_complete(lina.stop())
+
+
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
-    loop.run_forever()
\ No newline at end of file
+    lina = Lina()
+    if lina.args.workers > 1 and not lina.longpoll_enabled:
+        lina.logger.warning('dedup cache is per worker, a redelivery that '
+                            'reaches another worker is handled again')
+        Supervisor(partial(run, lina), lina.args.workers, lina.logger).run()
+    else:
+        if lina.args.workers > 1:
+            # every worker would poll and handle the same events
+            lina.logger.warning('--workers %s is ignored, long poll '
+                                'ingestion runs in a single process',
+                                lina.args.workers)
+        run(lina)
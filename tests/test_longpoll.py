@@ -0,0 +1,137 @@
+import asyncio
+from logging import getLogger
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple
+
+from aiohttp import ClientSession, web
+
+from lina_community_version.core.longpoll import LongPoll
+
+
+def new_message(conversation_message_id: int) -> Dict[str, Any]:
+    return {'type': 'message_new',
+            'object': dict(date=0, from_id=3, id=0, out=0, peer_id=5,
+                           text='лина ping',
+                           conversation_message_id=conversation_message_id,
+                           fwd_messages=[], important=False, random_id=0,
+                           attachments=[], is_hidden=False)}
+
+
+class FakeLongPollServer:
+    # Answers a_check with the scripted replies in order, then holds the
+    # request like an idle long poll does.
+    def __init__(self, replies: List[Any]) -> None:
+        self.replies = replies
+        self.polls: List[Tuple[str, str]] = list()
+        self.servers = 0
+        self.app = web.Application()
+        self.app.router.add_get('/lp', self.check)
+        self.runner = web.AppRunner(self.app)
+        self.url = ''
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = 'http://%s:%s/lp' % (host, port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def get_long_poll_server(self, group_id: int) -> Dict[str, Any]:
+        self.servers += 1
+        return dict(response=dict(server=self.url,
+                                  key='key%s' % self.servers,
+                                  ts=str(self.servers * 100)))
+
+    async def check(self, request: web.Request) -> web.Response:
+        self.polls.append((request.query['key'], request.query['ts']))
+        if len(self.polls) > len(self.replies):
+            await asyncio.sleep(1)
+            return web.json_response(dict(ts=request.query['ts'],
+                                          updates=[]))
+        reply = self.replies[len(self.polls) - 1]
+        if isinstance(reply, str):
+            return web.Response(text=reply)
+        return web.json_response(reply)
+
+
+async def run_long_poll(replies: List[Any],
+                        polls: int,
+                        fail: bool = False) -> Tuple[FakeLongPollServer,
+                                                     List[int], bool]:
+    server = FakeLongPollServer(replies)
+    await server.start()
+    handled: List[int] = list()
+
+    async def process_message(message):
+        handled.append(message.conversation_message_id)
+        if fail:
+            raise RuntimeError('handler failed')
+
+    owner = SimpleNamespace(cfg=dict(), logger=getLogger('test'), queue=None,
+                            process_message=process_message)
+    async with ClientSession() as session:
+        api = SimpleNamespace(
+            get_long_poll_server=server.get_long_poll_server,
+            session=SimpleNamespace(driver=SimpleNamespace(session=session)))
+        group = SimpleNamespace(group_id=1, owner=owner, api=api)
+        long_poll = LongPoll(group, wait=1, retry_delay=0.01)
+        await long_poll.start()
+        for _ in range(500):
+            if len(server.polls) > polls:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)  # let the last updates be handled
+        assert long_poll._task is not None
+        running = not long_poll._task.done()
+        await long_poll.stop()
+    await server.stop()
+    return server, handled, running
+
+
+def test_ts_is_resumed_after_updates():
+    server, handled, _ = asyncio.run(run_long_poll([
+        dict(ts='101', updates=[new_message(1)]),
+        dict(ts='103', updates=[new_message(2), new_message(3)]),
+    ], polls=2))
+    assert server.polls[:3] == [('key1', '100'), ('key1', '101'),
+                                ('key1', '103')]
+    assert server.servers == 1
+    assert sorted(handled) == [1, 2, 3]
+
+
+def test_failed_replies_recover():
+    server, handled, _ = asyncio.run(run_long_poll([
+        dict(failed=1, ts='150'),  # events lost, go on from the new ts
+        dict(failed=2),  # key expired, keep our ts
+        dict(failed=3),  # key and ts expired
+        dict(ts='301', updates=[new_message(1)]),
+    ], polls=4))
+    assert server.polls[:5] == [('key1', '100'), ('key1', '150'),
+                                ('key2', '150'), ('key3', '300'),
+                                ('key3', '301')]
+    assert handled == [1]
+
+
+def test_broken_replies_are_retried():
+    server, handled, _ = asyncio.run(run_long_poll([
+        '{not json',
+        dict(updates=[]),  # no ts
+        dict(ts='301', updates=[new_message(1)]),
+    ], polls=3))
+    assert server.polls[:4] == [('key1', '100'), ('key2', '100'),
+                                ('key3', '100'), ('key3', '301')]
+    assert handled == [1]
+
+
+def test_failing_update_does_not_stop_polling():
+    server, handled, running = asyncio.run(run_long_poll([
+        dict(ts='101', updates=[new_message(1)]),
+        dict(ts='102', updates=[new_message(2)]),
+    ], polls=2, fail=True))
+    assert running
+    assert server.polls[:3] == [('key1', '100'), ('key1', '101'),
+                                ('key1', '102')]
+    assert handled == [1, 2]